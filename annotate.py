@@ -1,27 +1,184 @@
 import PyPDF2
-import pdf, matcher, sigil
+import pdf, matcher, matchcache, sigil
 from collections import Counter
+import json
+import multiprocessing
 import os.path
+import traceback
 
 import argparse
 
-def annotate(input_filename, output_filename, pages=None):
-    rdr = pdf.SchematicReader(open(input_filename, 'rb'))
-    sigdict = sigil.SigilDict.from_json(open('scheming.json'))
+class Resources(object):
+    '''The files used by annotate(): the sigil library, the font map and the
+    font donor document. They are loaded once, and can be reloaded when any
+    of them changes on disk, so that long-running processes can reuse them.
 
-    font_name = rdr.add_dummy_font()
+    Also holds an optional MatchCache for the matches on each page.'''
+
+    def __init__(self, sigils_filename='scheming.json',
+            font_map_filename='font_map.json',
+            donor_filename='font_donor.pdf',
+            match_cache=None):
+        self.filenames = [sigils_filename, font_map_filename, donor_filename]
+        self.file_stamps = None
+        self.match_cache = match_cache
+
+        self.reload_if_changed()
+
+    def get_file_stamps(self):
+        stamps = []
+        for filename in self.filenames:
+            st = os.stat(filename)
+            stamps.append((st.st_mtime, st.st_size))
+        return stamps
+
+    def reload_if_changed(self):
+        '''Reload the files if they have changed since they were last loaded.
+
+        If a file can't be loaded, eg because it is missing or half-written,
+        the previously loaded files are kept and loading is retried next time.
+
+        Returns True iff the files were reloaded.'''
+
+        sigils_filename, font_map_filename, donor_filename = self.filenames
+
+        try:
+            file_stamps = self.get_file_stamps()
+            if file_stamps == self.file_stamps:
+                return False
+
+            sigdict = sigil.SigilDict.load(sigils_filename)
+            font_map = json.load(open(font_map_filename))
+            donor_data = open(donor_filename, 'rb').read()
+
+        except Exception:
+            if self.file_stamps is None:
+                raise
+
+            print 'Failed to reload annotation resources, keeping old ones'
+            traceback.print_exc()
+            return False
+
+        self.sigdict = sigdict
+        self.font_map = font_map
+        self.donor_data = donor_data
+        self.file_stamps = file_stamps
+
+        return True
+
+def annotate(input_filename, output_filename, pages=None, jobs=1, resources=None,
+        incremental=False, owner=None):
+    '''Add text to a PDF where sigils are found. owner identifies the
+    document in the match cache, see MatchCache.purge().'''
+
+    if resources is None:
+        resources = Resources()
+
+    rdr = pdf.SchematicReader(open(input_filename, 'rb'),
+            font_map=resources.font_map)
+    sigdict = resources.sigdict
+
+    font_name = rdr.add_dummy_font(resources.donor_data)
 
     if pages is None:
         pages = range(len(rdr.pages))
 
-    for page_no in pages:
+    pool = None
+    if jobs > 1:
+        # pages are independent until add_text(), so parse and match them in
+        # parallel, then add the text to each page in order
+        pool = multiprocessing.Pool(jobs, initializer=init_page_worker,
+                initargs=(input_filename, sigdict, resources.font_map,
+                    resources.match_cache, owner))
+        page_matches = pool.imap(match_page_in_worker, pages)
+    else:
+        page_matches = (match_page(rdr, page_no, sigdict, resources.match_cache, owner)
+                for page_no in pages)
+
+    sigils = {(s.char, s.angle): s for s in sigdict.all_sigils()}
+    all_matches = ([(sigils[(char, angle)], pos, scale) for (char, angle, pos, scale) in matches]
+            for matches in page_matches)
+
+    try:
+        for page_no, matches in zip(pages, all_matches):
+
+            rdr.add_text(page_no, font_name,
+                    [(s, pos, scale) for (s, pos, scale) in matches])
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    write_pdf(rdr, output_filename, incremental)
 
-        line_ops = rdr.get_line_ops(page_no)
+def match_pages(input_filename, pages, resources, owner=None):
+    '''Parse and match the given pages of a PDF, for annotate_from_matches().
 
-        matches = matcher.match_sigils(sigdict, line_ops)
+    Returns a JSON-serializable list with an entry for each page, containing
+    a (char, angle, origin, sf) tuple for each match.'''
 
+    rdr = pdf.SchematicReader(open(input_filename, 'rb'),
+            font_map=resources.font_map)
+
+    return [match_page(rdr, page_no, resources.sigdict, resources.match_cache, owner)
+            for page_no in pages]
+
+def match_page(rdr, page_no, sigdict, match_cache=None, owner=None):
+    '''Parse and match a page, or look up its matches in match_cache if the
+    same page has been matched before.
+
+    To avoid storing sigils, the matches are returned as (char, angle,
+    origin, sf) tuples, which identify the sigils independently of their
+    order in sigdict.'''
+
+    data = rdr.get_page_data(page_no)
+    ctm = rdr.get_initial_ctm(page_no)
+
+    # a SigilDict without a version hasn't been loaded from a file
+    if match_cache is not None and sigdict.version is not None:
+        key = match_cache.key(sigdict.version, data, ctm)
+        matches = match_cache.get(key, owner)
+        if matches is not None:
+            return matches
+    else:
+        key = None
+
+    matches = [(m.sig.char, m.sig.angle, m.origin, m.sf)
+            for m in matcher.match_sigils(sigdict, pdf.parse_line_ops(data, ctm))]
+
+    if key is not None:
+        match_cache.put(key, matches, owner)
+
+    return matches
+
+def annotate_from_matches(input_filename, output_filename, page_matches, resources,
+        incremental=False):
+    '''Add text to a PDF given the matches on each page, as a dict mapping each
+    page number to its entry in the output of match_pages().'''
+
+    rdr = pdf.SchematicReader(open(input_filename, 'rb'),
+            font_map=resources.font_map)
+
+    font_name = rdr.add_dummy_font(resources.donor_data)
+
+    # add_text() only needs the char and angle of each sigil
+    sigils = {(s.char, s.angle): s for s in resources.sigdict.all_sigils()}
+
+    for page_no in sorted(page_matches):
         rdr.add_text(page_no, font_name,
-                [(s, pos, scale) for (s, pos, scale) in matches])
+                [(sigils[(char, angle)], pos, scale)
+                    for (char, angle, pos, scale) in page_matches[page_no]])
+
+    write_pdf(rdr, output_filename, incremental)
+
+def write_pdf(rdr, output_filename, incremental=False):
+    '''Write the modified document, either as a new PDF, or as the original
+    PDF followed by an incremental update.'''
+
+    if incremental:
+        with open(output_filename, 'wb') as f:
+            rdr.write_incremental_update(f)
+        return
 
     wtr = PyPDF2.PdfFileWriter()
     for p in rdr.pages:
@@ -29,10 +186,37 @@ def annotate(input_filename, output_filename, pages=None):
 
     wtr.write(open(output_filename, 'wb'))
 
+# state of each process in the pool used by annotate()
+worker_rdr = None
+worker_sigdict = None
+worker_match_cache = None
+worker_owner = None
+
+def init_page_worker(input_filename, sigdict, font_map, match_cache, owner):
+    global worker_rdr, worker_sigdict, worker_match_cache, worker_owner
+
+    worker_rdr = pdf.SchematicReader(open(input_filename, 'rb'),
+            font_map=font_map)
+    worker_sigdict = sigdict
+    worker_match_cache = match_cache
+    worker_owner = owner
+
+def match_page_in_worker(page_no):
+    '''Parse and match a page in a pool process, see match_page().'''
+
+    return match_page(worker_rdr, page_no, worker_sigdict, worker_match_cache,
+            worker_owner)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--pages', '-p', nargs='?',
             help="comma-separated list of pages to process [default: all]")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+            help='number of processes to match pages with [default: 1]')
+    parser.add_argument('--match-cache', metavar='DIR', default=None,
+            help='directory to cache the matches on each page in [default: none]')
+    parser.add_argument('--incremental', action='store_true',
+            help='append the text to a copy of the input instead of rewriting it')
     parser.add_argument('input', nargs='?', default='P1318-005a.pdf',
             help='path to input PDF  [default: P1318-005a.pdf]')
     parser.add_argument('output', nargs='?', default=None,
@@ -46,4 +230,9 @@ if __name__ == '__main__':
         root, ext = os.path.splitext(args.input)
         args.output = '{}_searchable{}'.format(root, ext)
 
-    annotate(args.input, args.output, pages=args.pages)
+    resources = None
+    if args.match_cache is not None:
+        resources = Resources(match_cache=matchcache.MatchCache(args.match_cache))
+
+    annotate(args.input, args.output, pages=args.pages, jobs=args.jobs,
+            resources=resources, incremental=args.incremental)
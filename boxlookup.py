@@ -1,48 +1,100 @@
-import bisect
+import math
+from collections import defaultdict
 
-class BoxLookup(object):
-    '''Allows searching for all points within a bounding box.'''
+class GridLookup(object):
+    '''Allows searching for all points within many bounding boxes, using
+    uniform grids of square cells.
+
+    Matches are grouped by their scale factors, in groups that each cover a
+    factor of two, and each group has its own grid with cells about the size
+    of its characters. A search only looks at the groups in a range of scale
+    factors, so on pages with text in several sizes, the boxes of large text
+    don't scan many tiny cells, and the boxes of small text don't scan cells
+    crowded with small characters.'''
+
+    def __init__(self, matches, unit_size):
+        '''unit_size is the cell size for matches with a scale factor of one,
+        eg the font size when looking for adjacent characters.'''
 
-    def __init__(self, matches):
         self.matches = matches
+        self.unit_size = float(unit_size)
+
+        # for each group of scale factors, the indices of the matches in each
+        # cell, in increasing order
+        self.grids = defaultdict(lambda: defaultdict(list))
+        for i, m in enumerate(matches):
+            group = self.group(m.sf)
+            self.grids[group][self.cell(group, *m.origin)].append(i)
 
         if len(matches) == 0:
             return
 
-        self.sorted_x_coords = sorted([m.origin[0] for m in matches])
-        self.sorted_y_coords = sorted([m.origin[1] for m in matches])
-        self.matches_by_x = sorted(matches, key=lambda m: m.origin[0])
-        self.matches_by_y = sorted(matches, key=lambda m: m.origin[1])
-
         self.x_range = max(m.origin[0] for m in matches) - \
                 min(m.origin[0] for m in matches)
         self.y_range = max(m.origin[1] for m in matches) - \
                 min(m.origin[1] for m in matches)
 
-    def search(self, min_x, min_y, max_x, max_y):
+    def group(self, sf):
+        return int(math.floor(math.log(sf, 2)))
+
+    def cell(self, group, x, y):
+        cell_size = self.unit_size * 2.0 ** group
+        return (int(math.floor(x / cell_size)),
+                int(math.floor(y / cell_size)))
+
+    def search(self, min_x, min_y, max_x, max_y, min_sf, max_sf):
+        '''Return the matches within the box (min_x, min_y, max_x, max_y),
+        leaving out some of those with scale factors outside
+        [min_sf, max_sf]. Only whole groups of matches are left out, so the
+        scale factors still need to be checked.
+
+        The matches are sorted by the coordinate along the narrowest side of
+        the box (relative to the spread of all matches), and then by their
+        position in the original list.'''
 
         if len(self.matches) == 0:
-            return
+            return []
 
-        # pick the narrowest side of the box for the primary lookup
-        if (max_x - min_x) / self.x_range < (max_y - min_y) / self.y_range:
-            sorted_coords = self.sorted_x_coords
-            sorted_matches = self.matches_by_x
-            first_min, first_max = min_x, max_x
-            second_min, second_max = min_y, max_y
-            second_coord = lambda m: m.origin[1]
+        matches = self.matches
+
+        # allow for rounding errors when the caller compares scale factors
+        first_group = self.group(min_sf * (1 - 1e-9))
+        last_group = self.group(max_sf * (1 + 1e-9))
+
+        found = []
+        for group in range(first_group, last_group + 1):
+            cells = self.grids.get(group)
+            if cells is None:
+                continue
+
+            (cx1, cy1) = self.cell(group, min_x, min_y)
+            (cx2, cy2) = self.cell(group, max_x, max_y)
+
+            # boxes that are long compared to the characters in the group can
+            # span more cells than there are matches, so then visit the
+            # occupied cells instead
+            if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) <= len(cells):
+                candidates = [i for cx in range(cx1, cx2 + 1)
+                        for cy in range(cy1, cy2 + 1)
+                        for i in cells.get((cx, cy), ())]
+            else:
+                candidates = [i for ((cx, cy), indices) in cells.iteritems()
+                        if cx1 <= cx <= cx2 and cy1 <= cy <= cy2
+                        for i in indices]
+
+            for i in candidates:
+                x, y = matches[i].origin
+                if min_x <= x <= max_x and min_y <= y <= max_y:
+                    found.append(i)
+
+        # sort along the narrowest side of the box
+        if self.x_range == 0 or self.y_range == 0:
+            axis = 1 if self.x_range == 0 else 0
+        elif (max_x - min_x) / self.x_range < (max_y - min_y) / self.y_range:
+            axis = 0
         else:
-            sorted_coords = self.sorted_y_coords
-            sorted_matches = self.matches_by_y
-            first_min, first_max = min_y, max_y
-            second_min, second_max = min_x, max_x
-            second_coord = lambda m: m.origin[0]
-
-        # find the range of valid primary coordinates
-        start = bisect.bisect_left(sorted_coords, first_min)
-        end = bisect.bisect_right(sorted_coords, first_max)
-
-        # check range against secondary coordinates and yield results
-        for m in sorted_matches[start:end]:
-            if second_min <= second_coord(m) <= second_max:
-                yield m
+            axis = 1
+
+        found.sort(key=lambda i: (matches[i].origin[axis], i))
+
+        return [matches[i] for i in found]
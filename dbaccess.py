@@ -1,5 +1,6 @@
 from sqlite3 import dbapi2 as sqlite3
 import sys
+import time
 
 class State(object):
     New = 0
@@ -8,26 +9,176 @@ class State(object):
     Succeeded = 3
     Deleted = 4
     Uploading = 5
+    Deleting = 6
+    DeletionFailed = 7
 
 def connect_db(db_path):
     """Connects to the specific database."""
-    rv = sqlite3.connect(db_path)
+    rv = sqlite3.connect(db_path, timeout=30)
     rv.row_factory = sqlite3.Row
+
+    # in write-ahead logging mode (see use_wal()), commits don't need to
+    # sync the database file. This setting isn't stored in the database, but
+    # it only sets a flag on the connection.
+    rv.execute('pragma synchronous = normal')
+
     return rv
 
+def use_wal(db):
+    """Switches the database to write-ahead logging, so that the web
+    interface can read while a worker writes. The journal mode is stored in
+    the database file, so this only needs to be done once."""
+    db.execute('pragma journal_mode = wal')
+
 def init_db(db_path, schema_path):
     """Initializes the database."""
     db = connect_db(db_path)
+    use_wal(db)
     with open(schema_path) as f:
         db.cursor().executescript(f.read())
     db.commit()
 
+def migrate_to_v1(db):
+    """Upgrades a database created with the original schema, which only had
+    the id, original_filename, state, error_msg and time_taken columns."""
+
+    columns = set(row[1] for row in db.execute('pragma table_info(uploaded)'))
+    new_columns = [
+        ('claim_token', 'text'),
+        ('lease_expires', 'real'),
+        ('attempts', 'integer not null default 0'),
+        ('content_hash', 'text'),
+        ('library_version', 'text'),
+        ('file_size', 'integer'),
+        ('page_count', 'integer'),
+        ('trailer_ok', 'integer'),
+        ('result_hash', 'text'),
+        ('created', 'real'),
+        ]
+
+    for name, definition in new_columns:
+        if name not in columns:
+            db.execute('alter table uploaded add column {} {}'.format(name, definition))
+
+    # existing uploads are kept for the full retention period from now
+    db.execute('update uploaded set created = ? where created is null', [time.time()])
+
+    db.execute('''create table if not exists page_tasks (
+        id integer primary key autoincrement,
+        upload_id integer not null references uploaded(id),
+        first_page integer not null,
+        end_page integer not null,
+        state integer not null,
+        error_msg text,
+        result text,
+        claim_token text,
+        lease_expires real,
+        attempts integer not null default 0
+    )''')
+
+    db.execute('''create table if not exists uploaded_archive (
+        id integer primary key,
+        original_filename text not null,
+        state integer not null,
+        time_taken real,
+        created real,
+        archived real not null
+    )''')
+
+    db.execute('create index if not exists uploaded_content_hash on uploaded (content_hash, library_version)')
+    db.execute('create index if not exists uploaded_state on uploaded (state)')
+    db.execute('create index if not exists page_tasks_state on page_tasks (state)')
+    db.execute('create index if not exists page_tasks_upload on page_tasks (upload_id, state)')
+
+def migrate_to_v2(db):
+    """Adds the maintenance table, see apply_retention()."""
+
+    db.execute('''create table maintenance (
+        name text primary key,
+        last_run real not null
+    )''')
+    db.execute("insert into maintenance (name, last_run) values ('retention', 0)")
+
+# functions that each upgrade the schema by one version. schema.sql creates
+# the latest version, so its user_version must be updated when adding one.
+MIGRATIONS = [migrate_to_v1, migrate_to_v2]
+
+def migrate_db(db_path):
+    """Upgrades the database to the latest schema version."""
+    db = connect_db(db_path)
+
+    # manage the transactions explicitly, since the sqlite3 module commits
+    # before schema changes, and each migration should be atomic
+    db.isolation_level = None
+
+    use_wal(db)
+
+    version = db.execute('pragma user_version').fetchone()[0]
+
+    for i in range(version, len(MIGRATIONS)):
+        db.execute('begin immediate')
+        try:
+            MIGRATIONS[i](db)
+            db.execute('pragma user_version = {}'.format(i + 1))
+        except:
+            db.execute('rollback')
+            raise
+        db.execute('commit')
+
+    db.close()
+
+    return version, len(MIGRATIONS)
+
+def apply_retention(db, archive_age, interval, expiry_age=None):
+    """Moves deleted uploads created more than archive_age seconds ago to the
+    uploaded_archive table, which keeps the uploaded table small. Does
+    nothing if this has been done by any process in the last interval
+    seconds.
+
+    If expiry_age is given, uploads created more than expiry_age seconds ago
+    are deleted too: the files of succeeded and failed uploads (and of any
+    uploads that were interrupted) are erased by the workers, as if the
+    users had deleted them.
+
+    Returns True iff the retention policy was applied."""
+
+    now = time.time()
+    cutoff = now - archive_age
+
+    # the update takes the write lock until the commit, so only one process
+    # can claim each run
+    cur = db.execute('update maintenance set last_run = ? where name = ? and last_run < ?',
+            [now, 'retention', now - interval])
+    if cur.rowcount != 1:
+        db.commit()
+        return False
+
+    if expiry_age is not None:
+        db.execute('update uploaded set state = ?, attempts = 0 '
+                'where state in (?, ?, ?) and created < ?',
+                [State.Deleting, State.Succeeded, State.Failed, State.Uploading,
+                    now - expiry_age])
+
+    db.execute('insert into uploaded_archive '
+            '(id, original_filename, state, time_taken, created, archived) '
+            'select id, original_filename, state, time_taken, created, ? '
+            'from uploaded where state = ? and created < ?',
+            [now, State.Deleted, cutoff])
+    db.execute('delete from uploaded where state = ? and created < ?',
+            [State.Deleted, cutoff])
+
+    db.commit()
+
+    return True
+
 if __name__ == '__main__':
     if len(sys.argv) == 4 and sys.argv[1] == 'initdb':
         init_db(sys.argv[2], sys.argv[3])
         print('Initialized the database.')
+    elif len(sys.argv) == 3 and sys.argv[1] == 'migrate':
+        old_version, new_version = migrate_db(sys.argv[2])
+        print('Migrated the database from version {} to {}.'.format(old_version, new_version))
     else:
-        print('usage: {} initdb <db_path> <schema_path>')
+        print('usage: {0} initdb <db_path> <schema_path>\n'
+              '       {0} migrate <db_path>'.format(sys.argv[0]))
         sys.exit(1)
-
-
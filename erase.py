@@ -0,0 +1,45 @@
+'''Securely deletes files, for uploads that users have asked to delete.'''
+
+import errno
+import os
+
+CHUNK_SIZE = 1024 * 1024 # number of zero bytes to write at a time
+
+def secure_delete(path):
+    '''Overwrite a file with zeros before deleting it. Does nothing if the
+    file has already been deleted, so that interrupted deletions can be
+    retried.
+
+    The data is erased even if the file has other hard links, so files that
+    are still in use elsewhere should be deleted with unlink() instead.'''
+
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+
+    zeros = '\0' * CHUNK_SIZE
+
+    # overwrite in place, rather than truncating and writing new blocks
+    with open(path, 'r+b') as f:
+        remaining = st.st_size
+        while remaining > 0:
+            f.write(zeros[:remaining])
+            remaining -= min(remaining, CHUNK_SIZE)
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.remove(path)
+
+def unlink(path):
+    '''Delete a hard link to a file without erasing the data. Does nothing if
+    the file has already been deleted.'''
+
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,129 @@
+'''Streams uploaded files to disk, computing their hash and sniffing their
+structure on the way, so that uploads never need to be held in memory or
+read again by the web interface.'''
+
+import errno
+import hashlib
+import os
+import re
+import tempfile
+
+# the header must be in the first 1024 bytes
+HEADER_SIZE = 1024
+
+# the end of the file, which should contain the startxref and %%EOF
+TAIL_SIZE = 1024
+TRAILER_RE = re.compile(r'startxref\s+(\d+)\s+%%EOF\s*$')
+
+# page objects, which are counted to estimate the number of pages. Pages
+# inside compressed object streams are missed, and pages replaced by
+# incremental updates are counted twice.
+PAGE_RE = re.compile(r'/Type\s{0,8}/Page(?![A-Za-z0-9#])')
+MAX_PAGE_MATCH = 32 # longer than any match of PAGE_RE
+
+CHUNK_SIZE = 1024 * 1024 # number of bytes to read at a time in hash_file()
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadFile(object):
+    '''A file-like object for Werkzeug to write an uploaded file into. The
+    data is written to a temporary file in directory, which should be moved
+    into place when the upload is complete.
+
+    Raises UploadTooLarge if more than max_size bytes are written.'''
+
+    def __init__(self, directory, max_size=None):
+        fd, self.path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        self.file = os.fdopen(fd, 'w+b')
+        self.max_size = max_size
+
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.head = ''
+        self.tail = ''
+
+        # the end of the data so far, which is scanned again with the next
+        # chunk in case a page object is split between chunks
+        self.unscanned = ''
+        self.page_count = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.discard()
+            raise UploadTooLarge()
+
+        self.file.write(data)
+        self.hash.update(data)
+
+        if len(self.head) < HEADER_SIZE:
+            self.head += data[:HEADER_SIZE - len(self.head)]
+        self.tail = (self.tail + data)[-TAIL_SIZE:]
+
+        # count the matches that start before the last MAX_PAGE_MATCH bytes,
+        # and leave the rest for next time
+        data = self.unscanned + data
+        scan_end = len(data) - MAX_PAGE_MATCH
+        for m in PAGE_RE.finditer(data):
+            if m.start() >= scan_end:
+                break
+            self.page_count += 1
+        self.unscanned = data[max(scan_end, 0):]
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def finish(self):
+        '''Flush the file to disk and finish sniffing. Returns a dict of
+        properties of the file, for the uploaded table.'''
+
+        self.page_count += len(PAGE_RE.findall(self.unscanned))
+        self.unscanned = ''
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+        m = TRAILER_RE.search(self.tail)
+        trailer_ok = ('%PDF-' in self.head and m is not None and
+                int(m.group(1)) < self.size)
+
+        return {
+            'content_hash': self.hash.hexdigest(),
+            'file_size': self.size,
+            'page_count': self.page_count if self.page_count > 0 else None,
+            'trailer_ok': trailer_ok,
+            }
+
+    def is_pdf(self):
+        return '%PDF-' in self.head
+
+    def discard(self):
+        '''Close and delete the file, if it hasn't been moved already.'''
+
+        self.file.close()
+
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+def hash_file(path):
+    '''Return the SHA-256 of a file's contents, in the same form as the
+    content_hash computed by UploadFile.'''
+
+    h = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            h.update(chunk)
+
+    return h.hexdigest()
@@ -0,0 +1,159 @@
+import errno
+import hashlib
+import json
+import os
+import uuid
+
+import erase
+
+# change this when matcher.py changes in a way that affects the matches, so
+# that old cache entries are ignored
+FORMAT_VERSION = 2
+
+# eviction deletes entries until the cache is this fraction of its maximum
+# size, so that the directory doesn't need to be scanned on every put()
+EVICT_FRACTION = 0.9
+
+class MatchCache(object):
+    '''Stores the matches found on each page on disk, so that pages shared
+    between documents (eg title sheets and legends) only need to be matched
+    once.
+
+    Each entry is a file in directory, named after a hash of the page's
+    decoded content, its initial CTM and the version of the sigil library.
+    Entries are touched when they are used, and the least recently used ones
+    are deleted when the total size exceeds max_bytes. The cache can be
+    shared between processes, but each process only counts the size of the
+    entries it has added since it last scanned the directory, so the cache
+    can grow beyond max_bytes until one of them notices.
+
+    The entries contain text recognized in the documents, so they can be
+    tagged with an owner (eg the id of an upload), and deleted with purge()
+    when the document is deleted.'''
+
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024):
+        self.directory = directory
+        self.owners_directory = os.path.join(directory, 'owners')
+        self.max_bytes = max_bytes
+
+        # the total size of the entries, or None until the first eviction
+        self.size = None
+
+        try:
+            os.makedirs(self.owners_directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, library_version, data, ctm):
+        h = hashlib.sha1()
+        h.update('{}\0{}\0{!r}\0'.format(FORMAT_VERSION, library_version, ctm.tolist()))
+        h.update(data)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def owner_path(self, owner):
+        return os.path.join(self.owners_directory, '{}.keys'.format(owner))
+
+    def get(self, key, owner=None):
+        '''Return the matches stored under key, or None if there are none. If
+        owner is given, the entry is tagged with it.'''
+
+        path = self.path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                matches = json.load(f)
+
+            # mark as recently used
+            os.utime(path, None)
+
+        except (IOError, OSError, ValueError):
+            return None
+
+        if owner is not None:
+            self.tag(key, owner)
+
+        return matches
+
+    def put(self, key, matches, owner=None):
+        '''Store a JSON-serializable list of matches under key, tagged with
+        owner if it is given, then evict old entries if the cache is too big.'''
+
+        path = self.path(key)
+        data = json.dumps(matches)
+
+        # tag first, so that the entry is never left untagged
+        if owner is not None:
+            self.tag(key, owner)
+
+        # write to a temporary file first so that concurrent readers never
+        # see a partial entry
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+        if self.size is not None:
+            self.size += len(data)
+
+        if self.size is None or self.size > self.max_bytes:
+            self.evict()
+
+    def tag(self, key, owner):
+        '''Record that the entry under key was used for owner's document.'''
+
+        with open(self.owner_path(owner), 'ab') as f:
+            f.write(key + '\n')
+
+    def purge(self, owner):
+        '''Securely delete the entries used for owner's document, even if they
+        were also used for other documents.'''
+
+        path = self.owner_path(owner)
+
+        try:
+            with open(path, 'rb') as f:
+                keys = set(f.read().split())
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+        for key in keys:
+            erase.secure_delete(self.path(key))
+
+        erase.secure_delete(path)
+
+    def evict(self):
+        '''Delete the least recently used entries until the total size is
+        at most EVICT_FRACTION of max_bytes.'''
+
+        entries = []
+        total_size = 0
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # deleted by another process
+                continue
+
+            entries.append((st.st_mtime, name, st.st_size))
+            total_size += st.st_size
+
+        entries.sort()
+
+        for (_, name, size) in entries:
+            if total_size <= self.max_bytes * EVICT_FRACTION:
+                break
+
+            erase.secure_delete(os.path.join(self.directory, name))
+            total_size -= size
+
+        self.size = total_size
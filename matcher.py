@@ -2,8 +2,8 @@
 main interface.'''
 
 import math
-import re
-from boxlookup import BoxLookup
+import numpy
+from boxlookup import GridLookup
 
 from collections import defaultdict, Counter
 
@@ -20,31 +20,26 @@ class Match(object):
         self.prev_matches = []
         self.passes_alignment_check = False
 
+        # the next match in this match's series, and properties of the series
+        # from this match to its end, during the alignment check
+        self.series_next = None
+        self.rest_is_case_ambiguous = False
+        self.rest_has_long_match = False
 
-    def get_series(self):
-        '''During the alignment check, find all matches which are aligned
-        with this one, ie all the characters following this one in the current
-        word.'''
+    def position_along_text(self):
+        '''Return the x or y coordinate of the origin, depending on angle,
+        which increases along a series of aligned matches.'''
 
-        current = self
-        result = [self]
-
-        while len(current.next_matches) > 0:
-            current = current.next_match()
-            result.append(current)
-
-        return result
+        if self.sig.angle == 0:
+            return self.origin[0]
+        elif self.sig.angle == -90:
+            return self.origin[1]
 
     def next_match(self):
         '''Return the next aligned match, ie the one with the smallest
         x or y coordinate depending on angle.'''
 
-        if self.sig.angle == 0:
-            key = lambda m: m.origin[0]
-        elif self.sig.angle == -90:
-            key = lambda m: m.origin[1]
-
-        return min(self.next_matches, key=key)
+        return min(self.next_matches, key=Match.position_along_text)
 
     def __iter__(self):
         '''Hack for compatibility with old tuples.'''
@@ -58,6 +53,9 @@ def match_sigils(sigdict, abs_ops, skip_alignment_check=False):
     if len(abs_ops) < 2:
         return []
 
+    if not isinstance(abs_ops, sigil.LineOps):
+        abs_ops = sigil.LineOps.from_list(abs_ops)
+
     non_zero_abs_ops = sigil.remove_zero_ops(abs_ops)
     ops = sigil.diff_ops(non_zero_abs_ops)
 
@@ -72,7 +70,8 @@ def match_sigils(sigdict, abs_ops, skip_alignment_check=False):
     return matches
 
 def match_without_scale(sigdict, ops):
-    '''Find all possible matches based only on the directions of each line.
+    '''Find all possible matches based only on the directions of each line,
+    given the differential ops of the document as a LineOps.
 
     Returns an array matches of the form:
         [Match(sigil, start)]
@@ -80,27 +79,36 @@ def match_without_scale(sigdict, ops):
 
     matches = []
 
-    # wrap in ms to make it easier for the regex to match the divisions between
-    # continuous lines
-    all_opcodes = 'm{}m'.format(''.join(opcode for (_,opcode) in ops))
+    all_opcodes = ops.opcodes
 
     # combine sigils with rotated copies
-    all_sigils = sum(sigdict.values(), [])
-    all_sigils = all_sigils + [sig.rotated(-90) for sig in all_sigils]
+    all_sigils = sigdict.all_sigils()
 
-    for sig in all_sigils:
+    doc_vectors, doc_norms = sigil.ops_vectors(ops)
 
-        # first find all places where the correct sequence of operation types is present
-        sig_regex = '(?=m{}m)'.format(''.join(opcode for (_,opcode) in sig.ops))
+    # find all places where the correct sequence of operation types, in
+    # roughly the right directions, is present for every sigil in a single
+    # pass over the document
+    all_starts = sigdict.signature_trie().search(all_opcodes,
+            doc_vectors, doc_norms)
 
-        possible_starts = [m.start() for m in
-                re.finditer(sig_regex, all_opcodes)]
+    doc_is_curve = numpy.frombuffer(all_opcodes, dtype='S1') == 'c'
+    doc_tols = numpy.where(doc_is_curve, 0.7, 0.93)
 
-        # now at each position, check the directions of the operations are correct
-        for start in possible_starts:
-            doc_ops = ops[start : start+len(sig.ops)]
+    for sig, possible_starts in zip(all_sigils, all_starts):
+        if len(possible_starts) == 0:
+            continue
 
-            if all(match_op(doc_op, sig_op) for (doc_op, sig_op) in zip(doc_ops, sig.ops)):
+        # now at all positions, check the directions of the operations are
+        # correct: idx[i, j] is the index of op j of the match starting at
+        # possible_starts[i]
+        idx = numpy.add.outer(possible_starts, numpy.arange(len(sig.ops)))
+
+        valid = match_ops(doc_vectors[idx], doc_norms[idx],
+                sig.vectors, sig.norms, doc_tols[idx]).all(axis=1)
+
+        for start, is_valid in zip(possible_starts, valid):
+            if is_valid:
                 matches.append( Match(sig, start) )
 
     return matches
@@ -121,6 +129,21 @@ def match_op(step1, step2, tol=0.93):
 
     return (x1*x2+y1*y2)/n1/n2 > tol
 
+def match_ops(vectors1, norms1, vectors2, norms2, tols):
+    '''Batched version of match_op(). Given arrays of op vectors (with the
+    coords in the last axis), their lengths, and the tolerance for each pair,
+    return a boolean array which is True where the ops are in the same
+    direction.'''
+
+    zero1 = norms1 < 0.01
+    zero2 = norms2 < 0.01
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        dots = vectors1[..., 0]*vectors2[..., 0] + vectors1[..., 1]*vectors2[..., 1]
+        same_direction = dots/norms1/norms2 > tols
+
+    return numpy.where(zero1 | zero2, zero1 & zero2, same_direction)
+
 def remove_submatches(matches):
     '''Given a list of matches, removing all submatches.
 
@@ -156,50 +179,63 @@ def remove_submatches(matches):
     return matches
 
 def check_scales(matches, abs_ops, ops):
-    '''Given a list of matches, and the ops that they come from, calculate the
-    scale factor of each match.
+    '''Given a list of matches, and the ops that they come from (as
+    LineOps), calculate the scale factor of each match.
 
     Matches with inconsistent scale factors are removed.
 
     Returns a list of matches with the sf and origin members added.'''
 
-    processed_matches = []
+    doc_vectors, doc_norms = sigil.ops_vectors(ops)
+    abs_coords = abs_ops.coords
 
-    for m in matches:
-        doc_ops = ops[m.start:m.end]
+    # group matches by sigil, so that each group can be checked at once
+    matches_by_sigil = defaultdict(list)
+    for i, m in enumerate(matches):
+        matches_by_sigil[m.sig].append(i)
 
-        doc_sf = sigil.ops_scale(doc_ops) / m.sig.scale
+    passes_scale_check = [False] * len(matches)
 
-        # check scale factor of each operation
-        scale_error = False
-        for sig_op, doc_op in zip(m.sig.ops, doc_ops):
-            assert sig_op[1] == doc_op[1], "match_op() isn't doing its job"
+    for sig, indices in matches_by_sigil.items():
+        starts = numpy.array([matches[i].start for i in indices])
+
+        # idx[i, j] is the index of op j of the i-th match
+        idx = numpy.add.outer(starts, numpy.arange(len(sig.ops)))
+        doc_abs_vectors = numpy.abs(doc_vectors[idx])
 
-            sig_n = math.sqrt(sig_op[0][0]**2 + sig_op[0][1]**2)
-            doc_n = math.sqrt(doc_op[0][0]**2 + doc_op[0][1]**2)
+        # equivalent to sigil.ops_scale() for each match
+        doc_scales = 0
+        for j in range(len(sig.ops)):
+            doc_scales = doc_scales + (doc_abs_vectors[:, j, 0] + doc_abs_vectors[:, j, 1])
+        doc_sfs = doc_scales / sig.scale
+
+        # check scale factor of each operation
+        sig_n = sig.norms
+        doc_n = doc_norms[idx]
 
-            # set position tolerance based on operation type
-            if sig_op[1] == 'c':
-                tol = max(4 * doc_sf, 0.3)
-            else:
-                tol = 0.3
+        sig_zero = sig_n < 0.01
+        doc_zero = doc_n < 0.01
+        assert (sig_zero == doc_zero).all(), "match_op() isn't doing its job"
 
-            if sig_n < 0.01 or doc_n < 0.01:
-                assert sig_n < 0.01 and doc_n < 0.01, "match_op() isn't doing its job"
+        # set position tolerance based on operation type
+        is_curve = numpy.array([opcode == 'c' for (_, opcode) in sig.ops])
+        tols = numpy.where(is_curve, numpy.maximum(4 * doc_sfs[:, None], 0.3), 0.3)
 
-            else:
-                len_error = abs(doc_n - sig_n * doc_sf)
-                if len_error > tol:
-                    scale_error = True
+        len_errors = numpy.abs(doc_n - sig_n * doc_sfs[:, None])
+        scale_errors = ((len_errors > tols) & ~doc_zero).any(axis=1)
 
         # get absolute position of sig origin
-        start_op = abs_ops[m.start]
-        origin = [a+b*doc_sf for a,b in zip(start_op[0], m.sig.origin)]
+        origins = abs_coords[starts] + numpy.array(sig.origin) * doc_sfs[:, None]
 
-        if scale_error is False:
-            m.origin = origin
-            m.sf = doc_sf
-            processed_matches.append(m)
+        for i, origin, doc_sf, scale_error in zip(indices,
+                origins.tolist(), doc_sfs.tolist(), scale_errors):
+            if not scale_error:
+                matches[i].origin = origin
+                matches[i].sf = doc_sf
+                passes_scale_check[i] = True
+
+    processed_matches = [m for (m, passes) in
+            zip(matches, passes_scale_check) if passes]
 
     return processed_matches
 
@@ -229,7 +265,11 @@ def check_alignment(sigdict, matches):
     # hardcoded y alignment tolerance
     max_y_sep = 0.7
 
-    matches_bl = BoxLookup(matches)
+    if len(matches) == 0:
+        return matches
+
+    # index matches with grid cells about the size of a character
+    matches_gl = GridLookup(matches, v_width)
 
     # for each match, work out the range of possible starts of the next character:
     #   FROM x + width,
@@ -237,9 +277,8 @@ def check_alignment(sigdict, matches):
     #   TO   x + width + gap + space + gap + one more gap for tolerance,
     #        y + max_y_sep
     # or the corresponding rotated coordinates for a rotated character
-    #
-    # then, check all matches in this box for alignment and record them
-    for i, m in enumerate(matches):
+    boxes = []
+    for m in matches:
         x, y = m.origin
         assert m.sig.angle in [0, -90]
 
@@ -258,7 +297,11 @@ def check_alignment(sigdict, matches):
                 y + m.sf * (m.sig.width + 3 * gap_width + space_width),
                 ]
 
-        for m2 in matches_bl.search(*box):
+        boxes.append(box)
+
+    # then, check all matches in each box for alignment and record them
+    for m, box in zip(matches, boxes):
+        for m2 in matches_gl.search(*box, min_sf=m.sf * 0.9, max_sf=m.sf * 1.1):
 
             # remove matches at different angles or scales
             if m2.sig.angle != m.sig.angle:
@@ -270,17 +313,33 @@ def check_alignment(sigdict, matches):
             m2.prev_matches.append(m)
             m.next_matches.append(m2)
 
-    # identify whether matches are in valid serieses
+    # resolve the next match in the series of each match once. A series
+    # starts at a match with no previous matches and follows next_match() to
+    # its end.
     for m in matches:
-        if m.prev_matches != []:
-            # not start of series
-            continue
+        if len(m.next_matches) > 0:
+            m.series_next = m.next_match()
 
-        series = m.get_series()
+    # next matches always have a larger position, so in this order each match
+    # comes before the rest of its series
+    ordered_matches = sorted(matches, key=Match.position_along_text)
 
-        if series_is_valid(series):
-            for m2 in series:
-                m2.passes_alignment_check = True
+    # working backwards, find the properties of the rest of each series
+    for m in reversed(ordered_matches):
+        rest = m.series_next
+
+        m.rest_is_case_ambiguous = is_case_ambiguous(m) and \
+                (rest is None or rest.rest_is_case_ambiguous)
+        m.rest_has_long_match = is_long(m) or \
+                (rest is not None and rest.rest_has_long_match)
+
+    # working forwards, mark every match in a valid series
+    for m in ordered_matches:
+        if m.prev_matches == [] and series_is_valid(m):
+            m.passes_alignment_check = True
+
+        if m.passes_alignment_check and m.series_next is not None:
+            m.series_next.passes_alignment_check = True
 
     # finally, exclude invalid matches
     matches = [m for m in
@@ -288,17 +347,20 @@ def check_alignment(sigdict, matches):
 
     return matches
 
-def series_is_valid(series):
+def series_is_valid(start):
     '''A series of matches is valid if at least one has more than two
-    operations, and the series doesn't suffer case ambiguity (P, V, W, X, Z)'''
+    operations, and the series doesn't suffer case ambiguity (P, V, W, X, Z).
+
+    Takes the first match of the series, after the rest_* properties have
+    been calculated by check_alignment().'''
 
-    if all(m.sig.char.upper() in 'PVWXZ' for m in series):
-        return False
+    return start.rest_has_long_match and not start.rest_is_case_ambiguous
 
-    def match_is_valid(m):
-        return len(m.sig.ops) > 2
+def is_case_ambiguous(m):
+    return m.sig.char.upper() in 'PVWXZ'
 
-    return any(match_is_valid(m) for m in series)
+def is_long(m):
+    return len(m.sig.ops) > 2
 
 def count_ambiguous(matches):
     '''Return a Counter() of sigils matching the same operations in the
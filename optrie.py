@@ -0,0 +1,127 @@
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+OPCODES = 'mlc'
+
+# number of bins that op directions are quantized into, plus one extra bin for
+# zero-length ops
+N_BINS = 16
+ZERO_BIN = N_BINS
+
+# must agree with the tolerances used by matcher.match_op()
+LINE_TOL = 0.93
+CURVE_TOL = 0.7
+ZERO_TOL = 0.01
+
+def op_signatures(opcodes, vectors, norms):
+    '''Given a string of opcodes and the corresponding arrays of differential
+    op vectors and lengths (see sigil.ops_vectors()), return a list with the
+    signature of each op.
+
+    A signature is an integer identifying both the opcode and the quantized
+    direction of the op.'''
+
+    if numpy is None:
+        raise NotImplementedError('op_signatures() requires numpy')
+
+    angles = numpy.arctan2(vectors[:, 1], vectors[:, 0])
+    bins = numpy.floor(angles / (2 * numpy.pi) * N_BINS).astype(int) % N_BINS
+    bins[norms < ZERO_TOL] = ZERO_BIN
+
+    return [OPCODES.index(c) * (N_BINS + 1) + b
+            for (c, b) in zip(opcodes, bins.tolist())]
+
+def _probe_table():
+    '''For every signature of a document op, list the signatures of sigil ops
+    that could be in the same direction according to match_op().'''
+
+    bin_width = 360.0 / N_BINS
+    table = {}
+
+    for (i, c) in enumerate(OPCODES):
+        tol = CURVE_TOL if c == 'c' else LINE_TOL
+
+        # ops within acos(tol) of each other are at most this many bins apart
+        max_offset = int(math.ceil(math.degrees(math.acos(tol)) / bin_width))
+
+        for b in range(N_BINS):
+            table[i * (N_BINS + 1) + b] = tuple(sorted(set(
+                i * (N_BINS + 1) + (b + offset) % N_BINS
+                for offset in range(-max_offset, max_offset + 1))))
+
+        # zero-length ops only match other zero-length ops
+        zero_sig = i * (N_BINS + 1) + ZERO_BIN
+        table[zero_sig] = (zero_sig,)
+
+    return table
+
+PROBE_TABLE = _probe_table()
+
+class SignatureTrie(object):
+    '''Allows searching for the op signatures of many sigils at once.
+
+    An occurrence of a sigil must be delimited by 'm' operations (or the
+    ends of the document) on both sides, so that it lies on the divisions
+    between continuous lines. Occurrences are only candidates: the directions
+    of their ops still need to be checked with match_op().'''
+
+    def __init__(self, sigils):
+        self.n_sigils = len(sigils)
+
+        # each node maps a signature to the next node, and None to the indices
+        # of the sigils that end at that node
+        self.root = {}
+
+        for i, sig in enumerate(sigils):
+            opcodes = ''.join(opcode for (_, opcode) in sig.ops)
+
+            node = self.root
+            for signature in op_signatures(opcodes, sig.vectors, sig.norms):
+                node = node.setdefault(signature, {})
+            node.setdefault(None, []).append(i)
+
+    def search(self, opcodes, vectors, norms):
+        '''Given a string of opcodes and the corresponding op vectors and
+        lengths, find all places where each sigil's op signatures could be
+        present.
+
+        Returns a list with an entry for each sigil, containing the sorted
+        indices of the first operation of each candidate occurrence.'''
+
+        starts = [[] for _ in range(self.n_sigils)]
+        n = len(opcodes)
+        root = self.root
+
+        # the signatures of sigil ops that each document op could match
+        probes = [PROBE_TABLE[s] for s in op_signatures(opcodes, vectors, norms)]
+
+        # sigils can only start at the beginning of the document or after an
+        # 'm' operation
+        p = 0
+        while p <= n:
+            stack = [(root, p)]
+
+            while stack:
+                node, q = stack.pop()
+
+                if None in node and (q == n or opcodes[q] == 'm'):
+                    for i in node[None]:
+                        starts[i].append(p)
+
+                if q == n:
+                    continue
+
+                for signature in probes[q]:
+                    child = node.get(signature)
+                    if child is not None:
+                        stack.append((child, q + 1))
+
+            p = opcodes.find('m', p) + 1
+            if p == 0:
+                break
+
+        return starts
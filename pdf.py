@@ -1,71 +1,67 @@
 import PyPDF2
 
-from PyPDF2.pdf import ContentStream, PageObject
 from PyPDF2.generic import *
+from PyPDF2.utils import PdfReadError
 
-import numpy
+import io
 import json
+import math
+import numpy
+import re
+import struct
 
-class NovelContentStream(ContentStream):
-    def __init__(self, pdf):
-        self.pdf = pdf
-        self.operations = []
+from sigil import LineOps
 
 class SchematicReader(PyPDF2.PdfFileReader):
     def __init__(self, *args, **kwargs):
+        '''Accepts the same arguments as PdfFileReader, plus an optional
+        font_map, which is loaded from font_map.json if omitted.'''
+
+        font_map = kwargs.pop('font_map', None)
+
         super(SchematicReader, self).__init__(*args, **kwargs)
 
         # TODO: figure out how to convert between CID indices in the font we copy from
         # font_donor.pdf and real characters.
         #
         # For now, I generated this lookup table, but this is such a tragic copout.
-        self.font_map = json.load(open('font_map.json'))
-
-    def get_line_ops(self, page_no):
-        '''Return a list of line drawing operations on the given page.'''
-
-        contents = self.get_page_content(page_no)
+        if font_map is None:
+            font_map = json.load(open('font_map.json'))
+        self.font_map = font_map
 
-        ctm = self.get_initial_ctm(page_no)
+        # see add_object() and get_push_pop_streams(). Trailers from xref
+        # streams don't have a /Size, so look at the highest object number.
+        self.first_new_object_id = max([self.trailer.get('/Size', 0)] +
+                [max(ids) + 1 for ids in self.xref.values() if len(ids) > 0] +
+                [idnum + 1 for idnum in self.xref_objStm])
+        self.next_object_id = self.first_new_object_id
+        self.push_pop_streams = None
 
-        ctm_stack = []
+        # existing objects changed since the document was read, see
+        # mark_modified()
+        self.modified_objects = {}
 
-        line_ops = []
+        # see add_dummy_font() and text_layer_data()
+        self.glyph_widths = DefaultWidths({})
 
-        for op in contents.operations:
-            if op[1] == 'q':
-                ctm_stack.append(ctm)
-
-            elif op[1] == 'Q':
-                ctm = ctm_stack.pop()
-
-            elif op[1] == 'c':
-                coords1 = ctm.dot(map(float, op[0][0:2]) + [1])
-                coords2 = ctm.dot(map(float, op[0][2:4]) + [1])
-                coords3 = ctm.dot(map(float, op[0][4:6]) + [1])
-                line_ops.append(((coords1[0], coords1[1]), op[1]))
-                line_ops.append(((coords2[0], coords2[1]), op[1]))
-                line_ops.append(((coords3[0], coords3[1]), op[1]))
-
-            elif op[1] == 'cm':
-                a,b,c,d,e,f = map(float, op[0])
-                try:
-                    ctm = ctm.dot(numpy.array([[ a,  c, e],
-                                           [ b,  d, f],
-                                           [ 0,  0, 1]]))
-                except:
-                    import pdb; pdb.set_trace()
+    def get_line_ops(self, page_no):
+        '''Return the line drawing operations on the given page as a
+        LineOps.'''
 
-            elif op[1] in 'ml':
-                coords = ctm.dot(map(float, op[0]) + [1])
-                line_ops.append(((coords[0], coords[1]), op[1]))
+        return parse_line_ops(self.get_page_data(page_no),
+                self.get_initial_ctm(page_no))
 
-        return line_ops
+    def get_page_data(self, page_no):
+        '''Load the decoded data of the content stream(s) of a page.'''
+        contents = self.getPage(page_no).getContents()
 
-    def get_page_content(self, page_no):
-        '''Load the content stream of a page.'''
-        page = self.getPage(page_no)
-        return ContentStream(page.getContents(), page.pdf)
+        if contents is None:
+            return ''
+        elif isinstance(contents, ArrayObject):
+            # streams in an array are split at token boundaries
+            return '\n'.join(s.getObject().getData() for s in contents)
+        else:
+            return contents.getData()
 
     def get_initial_ctm(self, page):
         '''Initialise the current transformation matrix (CTM) by looking at
@@ -101,12 +97,20 @@ class SchematicReader(PyPDF2.PdfFileReader):
         else:
             raise NotImplementedError('unhandled rotation: %r' % rotation)
 
-    def add_dummy_font(self):
+    def add_dummy_font(self, donor_data=None):
         '''Load a font from a dummy donor document and merge it into every page,
-        returning the name of the new font.'''
+        returning the name of the new font.
+
+        donor_data is the contents of the donor document, which is read from
+        font_donor.pdf if omitted.'''
 
-        # load the donor font
-        rdr = PyPDF2.PdfFileReader(open('font_donor.pdf', 'rb'))
+        if donor_data is None:
+            donor_data = open('font_donor.pdf', 'rb').read()
+
+        # load the donor font and copy its objects into this document. The
+        # objects are modified when they are copied, so they can't be shared
+        # between documents.
+        rdr = PyPDF2.PdfFileReader(io.BytesIO(donor_data))
         donor_page = rdr.getPage(0)
         donor_resources = donor_page['/Resources'].getObject()
         donor_fonts = donor_resources['/Font'].values()
@@ -114,7 +118,8 @@ class SchematicReader(PyPDF2.PdfFileReader):
         assert len(donor_fonts) == 1
 
         new_font_name = '/FINJ'
-        new_font_data = donor_fonts[0]
+        new_font_data = self.import_object(donor_fonts[0])
+        self.glyph_widths = get_glyph_widths(new_font_data.getObject())
 
         # add font dictionaries to every page of the target pdf and
         # collect all existing font names
@@ -134,64 +139,229 @@ class SchematicReader(PyPDF2.PdfFileReader):
         for page in self.pages:
             page['/Resources'].getObject()['/Font'][NameObject(new_font_name)] = new_font_data
 
+            # the font dictionary may be part of the page dictionary, or of
+            # an indirect resource dictionary, or an indirect object itself
+            self.mark_modified(page.indirectRef, page)
+            if isinstance(page.raw_get('/Resources'), IndirectObject):
+                self.mark_modified(page.raw_get('/Resources'))
+            if isinstance(page['/Resources'].raw_get('/Font'), IndirectObject):
+                self.mark_modified(page['/Resources'].raw_get('/Font'))
+
         return new_font_name
 
     def add_text(self, page_no, font, text_items, debug=False):
-        '''Adds text, given as a {string: coords} to the given page.'''
+        '''Adds text, given as a {string: coords} to the given page.
+
+        The original content streams are left as they are, wrapped in q/Q
+        so that their graphics state doesn't affect the text, and the text is
+        appended to the /Contents array as a separate compressed stream.'''
 
         page = self.getPage(page_no)
 
-        newContentsArray = ArrayObject()
-        newContentsArray.append(PageObject._pushPopGS(page.getContents(), page.pdf))
+        addedContents = DecodedStreamObject()
+        addedContents.setData(self.text_layer_data(page, font, text_items, debug))
+
+        push, pop = self.get_push_pop_streams()
 
-        addedContents = NovelContentStream(page.pdf)
-        addedContents.operations = self.text_to_operations(page, font, text_items, debug)
-        newContentsArray.append(addedContents)
+        newContentsArray = ArrayObject([push])
+        newContentsArray.extend(self.get_content_refs(page))
+        newContentsArray.append(pop)
+        newContentsArray.append(self.add_object(addedContents.flateEncode()))
 
-        newContents = ContentStream(newContentsArray, page.pdf).flateEncode()
+        page[NameObject('/Contents')] = newContentsArray
+        self.mark_modified(page.indirectRef, page)
 
-        page[NameObject('/Contents')] = newContents
+    def get_content_refs(self, page):
+        '''Return a list of references to the content streams of a page,
+        without loading them.'''
 
-    def text_to_operations(self, *args, **kwargs):
+        if '/Contents' not in page:
+            return []
 
-        def to_pypdf2_object(x):
-            '''Convert a Python object to a PyPDF2 object.'''
-            if isinstance(x, PdfObject):
-                return x
-            elif isinstance(x, str):
-                return TextStringObject(x)
-            elif isinstance(x, int):
-                return NumberObject(x)
-            elif isinstance(x, float):
-                return FloatObject('%.2f' % x)
+        contents = page.raw_get('/Contents')
+
+        if isinstance(contents, IndirectObject):
+            if isinstance(contents.getObject(), ArrayObject):
+                contents = contents.getObject()
             else:
-                raise NotImplementedError('unrecognised object: %r' % x)
+                return [contents]
+
+        if isinstance(contents, ArrayObject):
+            # the elements of an array of streams are references
+            return list(contents)
+
+        # a stream directly in the page dictionary, which isn't allowed but
+        # can't be referenced from an array either
+        return [self.add_object(contents)]
+
+    def get_push_pop_streams(self):
+        '''Return references to streams containing just q and just Q, shared
+        between all pages.'''
+
+        if self.push_pop_streams is None:
+            push, pop = DecodedStreamObject(), DecodedStreamObject()
+            # the streams in an array are concatenated, so separate the
+            # operators from the neighbouring streams' tokens
+            push.setData('q\n')
+            pop.setData('\nQ\n')
+
+            self.push_pop_streams = (self.add_object(push), self.add_object(pop))
+
+        return self.push_pop_streams
+
+    def add_object(self, obj):
+        '''Add a new indirect object to the document, returning a reference
+        to it.'''
+
+        idnum = self.next_object_id
+        self.next_object_id += 1
+
+        self.cacheIndirectObject(0, idnum, obj)
 
-        def to_operation(operation):
-            return (tuple(map(to_pypdf2_object, operation[0])),
-                    to_pypdf2_object(operation[1]))
+        return IndirectObject(idnum, 0, self)
+
+    def import_object(self, obj, imported=None):
+        '''Copy an object from another document into this one, along with
+        the objects it refers to, modifying it in place.
+
+        Returns the object, or a reference to the copy if it is indirect.'''
+
+        if imported is None:
+            imported = {}
+
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key not in imported:
+                # allocate the reference first, in case the object refers
+                # back to itself
+                ref = imported[key] = self.add_object(NullObject())
+                self.resolvedObjects[(0, ref.idnum)] = \
+                        self.import_object(obj.getObject(), imported)
+            return imported[key]
+
+        elif isinstance(obj, DictionaryObject):
+            for key, value in obj.items():
+                obj[key] = self.import_object(value, imported)
+
+        elif isinstance(obj, ArrayObject):
+            obj[:] = [self.import_object(value, imported) for value in obj]
+
+        return obj
+
+    def mark_modified(self, ref, obj=None):
+        '''Record that an existing indirect object has been modified, so that
+        it is included in an incremental update.
+
+        obj is the modified object, if it isn't the one that ref resolves to,
+        eg for pages, which are copied by getPage().'''
+
+        if obj is None:
+            obj = ref.getObject()
+
+        self.modified_objects[(ref.idnum, ref.generation)] = obj
+
+    def write_incremental_update(self, stream):
+        '''Write the original document followed by an incremental update
+        that contains only the new and modified objects.
+
+        This is much faster than writing the whole document with a
+        PdfFileWriter, and leaves the original objects untouched.'''
+
+        if self.isEncrypted:
+            raise NotImplementedError('incremental updates of encrypted documents')
+
+        self.stream.seek(0)
+        original_data = self.stream.read()
+
+        # the last startxref gives the position of the newest xref section
+        prev_xref = int(re.findall(r'startxref\s+(\d+)', original_data[-1024:])[-1])
+        xref_is_stream = not original_data[prev_xref:].lstrip().startswith('xref')
+
+        stream.write(original_data)
+        stream.write('\n')
+
+        objects = dict(self.modified_objects)
+        for idnum in range(self.first_new_object_id, self.next_object_id):
+            objects[(idnum, 0)] = self.getObject(IndirectObject(idnum, 0, self))
+
+        offsets = {}
+        for (idnum, generation), obj in sorted(objects.items()):
+            offsets[idnum] = (stream.tell(), generation)
+            write_object(stream, idnum, generation, obj)
+
+        trailer = DictionaryObject()
+        for key in ['/Root', '/Info', '/ID']:
+            if key in self.trailer:
+                trailer[NameObject(key)] = self.trailer.raw_get(key)
+        trailer[NameObject('/Prev')] = NumberObject(prev_xref)
+
+        xref_location = stream.tell()
+
+        if xref_is_stream:
+            # an xref stream can only be followed by another xref stream
+            xref_idnum = self.next_object_id
+            offsets[xref_idnum] = (xref_location, 0)
+
+            xref = DecodedStreamObject()
+            xref.setData(''.join(struct.pack('>BIH', 1, offset, generation)
+                for (_, (offset, generation)) in sorted(offsets.items())))
+
+            # flateEncode() doesn't keep the stream dictionary
+            xref = xref.flateEncode()
+            xref.update(trailer)
+            xref.update({
+                NameObject('/Type'): NameObject('/XRef'),
+                NameObject('/Size'): NumberObject(xref_idnum + 1),
+                NameObject('/W'): ArrayObject(map(NumberObject, [1, 4, 2])),
+                NameObject('/Index'): ArrayObject(
+                    [NumberObject(n) for n in xref_subsections(sorted(offsets))]),
+                })
+
+            write_object(stream, xref_idnum, 0, xref)
+
+        else:
+            stream.write('xref\n')
 
-        return map(to_operation,
-                self.text_to_unwrapped_operations(*args, **kwargs))
+            ids = sorted(offsets)
+            subsections = xref_subsections(ids)
+            for start, count in zip(subsections[::2], subsections[1::2]):
+                stream.write('{} {}\n'.format(start, count))
+                for idnum in range(start, start + count):
+                    stream.write('%010d %05d n\r\n' % offsets[idnum])
 
-    def text_to_unwrapped_operations(self, page, font, text_items, debug):
-        yield ([], 'BT')
+            trailer[NameObject('/Size')] = NumberObject(self.next_object_id)
+            stream.write('trailer\n')
+            trailer.writeToStream(stream, None)
+            stream.write('\n')
+
+        stream.write('startxref\n{}\n%%EOF\n'.format(xref_location))
+
+    def text_layer_data(self, page, font, text_items, debug=False):
+        '''Return the data of a content stream that shows the given text
+        items on a page, given as (sigil, origin, scale) tuples.
+
+        Consecutive characters on the same baseline and with the same scale
+        are shown with a single TJ operator, using kerning to position each
+        character.'''
+
+        lines = ['BT']
 
         # this font size here seems to have no effect, and you
         # have to change the scale factor in the text matrix
-        yield ([NameObject(font), 1], 'Tf')
+        lines.append('{} 1 Tf'.format(font))
 
         if debug:
             # switch to red text for debugging
-            yield ([1, 0, 0], 'rg')
+            lines.append('1 0 0 rg')
         else:
-            yield ([3], 'Tr')
+            lines.append('3 Tr')
 
         itm = numpy.linalg.inv(self.get_initial_ctm(page))
 
+        run = None
+
         for sig, (x, y), scale in text_items:
-            raw_vector_homogenous = itm.dot([x, y, 1])
-            raw_vector = list(raw_vector_homogenous[:2])
+            raw_x, raw_y = map(format_number, itm.dot([x, y, 1])[:2])
 
             # 15 was chosen by trial and error to approximately match
             # size of chars in development doc
@@ -204,12 +374,309 @@ class SchematicReader(PyPDF2.PdfFileReader):
                                                [ 0, 0, 1]]).dot(raw_orientation)
 
             # arrange matrix coefficients into correct order for Tm parameters
-            text_params = list(raw_orientation[[0, 1, 0, 1], [0, 0, 1, 1]]) + raw_vector
+            text_matrix = map(format_number,
+                    raw_orientation[[0, 1, 0, 1], [0, 0, 1, 1]])
+
+            # the font uses two-byte character codes, which are its CIDs
+            code = self.font_map[sig.char]
+            cid = ord(code[0]) * 256 + ord(code[1])
+
+            if run is not None and run.try_to_add(text_matrix,
+                    float(raw_x), float(raw_y), cid, self.glyph_widths):
+                continue
+
+            if run is not None:
+                lines.append(run.to_data())
+
+            lines.append(' '.join(text_matrix + [raw_x, raw_y, 'Tm']))
+            run = TextRun(text_matrix, float(raw_x), float(raw_y), cid,
+                    self.glyph_widths)
+
+        if run is not None:
+            lines.append(run.to_data())
+
+        lines.append('ET')
+
+        return '\n'.join(lines) + '\n'
+
+def write_object(stream, idnum, generation, obj):
+    stream.write('{} {} obj\n'.format(idnum, generation))
+    obj.writeToStream(stream, None)
+    stream.write('\nendobj\n')
+
+def xref_subsections(ids):
+    '''Given a sorted list of object numbers, return a flat list of the
+    first object number and number of objects in each run of consecutive
+    numbers, as used in xref tables and streams.'''
+
+    subsections = []
+    for idnum in ids:
+        if len(subsections) > 0 and subsections[-2] + subsections[-1] == idnum:
+            subsections[-1] += 1
+        else:
+            subsections.extend([idnum, 1])
+
+    return subsections
+
+def format_number(x):
+    '''Format a number for a content stream, to two decimal places.'''
+
+    s = ('%.2f' % x).rstrip('0').rstrip('.')
+    return '0' if s == '-0' else s
+
+def get_glyph_widths(font):
+    '''Given a Type0 font dictionary, return a dict mapping the CIDs of the
+    glyphs to their widths, in thousandths of a unit of text space.'''
+
+    descendant = font['/DescendantFonts'][0].getObject()
+    w = [x.getObject() for x in descendant.get('/W', [])]
+    default = float(descendant.get('/DW', DEFAULT_GLYPH_WIDTH))
+
+    widths = {}
+    i = 0
+    while i < len(w):
+        # either "first [w1 w2 ...]" or "first last w"
+        if isinstance(w[i + 1], ArrayObject):
+            cid_widths = enumerate(w[i + 1], int(w[i]))
+            i += 2
+        else:
+            cid_widths = ((cid, w[i + 2]) for cid in range(int(w[i]), int(w[i + 1]) + 1))
+            i += 3
+
+        for cid, width in cid_widths:
+            widths[cid] = float(width)
+
+    return DefaultWidths(widths, default)
+
+# the width of glyphs not in a font's /W array, unless it has a /DW
+DEFAULT_GLYPH_WIDTH = 1000
+
+class DefaultWidths(dict):
+    def __init__(self, widths, default=DEFAULT_GLYPH_WIDTH):
+        super(DefaultWidths, self).__init__(widths)
+        self.default = default
 
-            yield (text_params, 'Tm')
-            yield ([ByteStringObject(self.font_map[sig.char])], 'Tj')
+    def __missing__(self, cid):
+        return self.default
 
-        yield ([], 'ET')
+# characters are only combined into a TJ if they are at most this many units
+# of text space beyond the end of the previous character
+MAX_TJ_GAP = 1.0
+
+# and if they are within this many units of user space of the baseline
+BASELINE_TOL = 0.01
+
+class TextRun(object):
+    '''Characters on the same baseline, shown with a TJ operator.
+
+    Positions are measured from the origin of the first character, along the
+    baseline in units of text space.'''
+
+    def __init__(self, text_matrix, x, y, cid, glyph_widths):
+        self.text_matrix = text_matrix
+
+        a, b, c, d = map(float, text_matrix)
+        self.origin = (x, y)
+        self.inverse_matrix = numpy.linalg.inv([[a, c], [b, d]])
+        self.scale = math.hypot(c, d)
+
+        # the hex character codes and kerning adjustments of the TJ operand
+        self.items = ['%04x' % cid]
+
+        self.position = 0.0
+        self.end = glyph_widths[cid] / 1000.0
+
+    def try_to_add(self, text_matrix, x, y, cid, glyph_widths):
+        '''Add a character to the run if it is on the same baseline and
+        not far beyond the end of the previous character.
+
+        Returns True iff it was added.'''
+
+        if text_matrix != self.text_matrix:
+            return False
+
+        along, across = self.inverse_matrix.dot(
+                [x - self.origin[0], y - self.origin[1]])
+
+        if abs(across) * self.scale > BASELINE_TOL:
+            return False
+
+        if not self.position < along <= self.end + MAX_TJ_GAP:
+            return False
+
+        # kerning is in thousandths of a unit, and moves the next character
+        # backwards
+        kerning = int(round((self.end - along) * 1000))
+        if kerning != 0:
+            self.items.append(kerning)
+
+        self.items.append('%04x' % cid)
+
+        self.position = self.end - kerning / 1000.0
+        self.end = self.position + glyph_widths[cid] / 1000.0
+
+        return True
+
+    def to_data(self):
+        '''Return the TJ operator for the run.'''
+
+        operands = []
+        for item in self.items:
+            if isinstance(item, int):
+                operands.append(str(item))
+            elif len(operands) > 0 and operands[-1].endswith('>'):
+                # merge adjacent strings
+                operands[-1] = operands[-1][:-1] + item + '>'
+            else:
+                operands.append('<' + item + '>')
+
+        return '[' + ' '.join(operands) + '] TJ'
+
+def transform_points(ctm, raw_coords):
+    '''Given a CTM and a flat list of raw x and y coordinates, return an Nx2
+    array of the transformed points.'''
+
+    points = numpy.array(raw_coords, dtype=float).reshape(-1, 2)
+    xs, ys = points[:, 0], points[:, 1]
+
+    # terms are added in the same order as ctm.dot([x, y, 1]), so that the
+    # results are identical to transforming each point separately
+    return numpy.column_stack((
+        (ctm[0, 0] * xs + ctm[0, 2]) + ctm[0, 1] * ys,
+        (ctm[1, 0] * xs + ctm[1, 2]) + ctm[1, 1] * ys))
+
+# the operators yielded by iter_path_operations()
+PATH_OPERATORS = set(['q', 'Q', 'cm', 'm', 'l', 'c'])
+
+# whitespace and comments, then one token of a content stream
+SKIP_PATTERN = r'(?: [\s\x00] | %[^\r\n]*(?![^\r\n]) )*'
+REGULAR_CHAR = r'[^\s\x00()<>\[\]{}/%]'
+SKIP_RE = re.compile(SKIP_PATTERN, re.VERBOSE)
+TOKEN_RE = re.compile(SKIP_PATTERN + r'''
+    (?:
+        (?P<number> [+-]? (?: \d+\.?\d* | \.\d+ ) ) (?! REGULAR )
+      | (?P<operator> REGULAR+ )
+      | (?P<string> \( )
+      | (?P<other> /REGULAR* | << | >> | <[^>]*> | [\[\]{}] )
+    )'''.replace('REGULAR', REGULAR_CHAR), re.VERBOSE)
+
+STRING_RE = re.compile(r'\\.|[()]', re.DOTALL)
+INLINE_IMAGE_START_RE = re.compile(r'(?<=[\s\x00])ID[\s\x00]')
+INLINE_IMAGE_END_RE = re.compile(r'[\s\x00]EI(?!' + REGULAR_CHAR + ')')
+
+def parse_line_ops(data, ctm):
+    '''Return the line drawing operations in the decoded data of a page's
+    content stream(s), given the page's initial CTM, as a LineOps.'''
+
+    ctm_stack = []
+
+    # transformed coordinates and opcodes of each segment of ops drawn
+    # with the same CTM
+    segments = []
+
+    # raw coordinates and opcodes of the current segment
+    raw_coords = []
+    opcodes = []
+
+    def end_segment():
+        if len(opcodes) > 0:
+            segments.append((transform_points(ctm, raw_coords), opcodes))
+
+    for op in iter_path_operations(data):
+        if op[1] == 'q':
+            ctm_stack.append(ctm)
+
+        elif op[1] == 'Q':
+            end_segment()
+            raw_coords, opcodes = [], []
+
+            ctm = ctm_stack.pop()
+
+        elif op[1] == 'c':
+            raw_coords.extend(map(float, op[0][0:6]))
+            opcodes.extend(op[1] * 3)
+
+        elif op[1] == 'cm':
+            end_segment()
+            raw_coords, opcodes = [], []
+
+            a,b,c,d,e,f = map(float, op[0])
+            ctm = ctm.dot(numpy.array([[ a,  c, e],
+                                       [ b,  d, f],
+                                       [ 0,  0, 1]]))
+
+        elif op[1] in 'ml':
+            x, y = map(float, op[0])
+            raw_coords.extend((x, y))
+            opcodes.append(op[1])
+
+    end_segment()
+
+    if len(segments) == 0:
+        return LineOps(numpy.zeros((0, 2)), '')
+
+    return LineOps(numpy.concatenate([coords for (coords, _) in segments]),
+            ''.join(''.join(opcodes) for (_, opcodes) in segments))
+
+def iter_path_operations(data):
+    '''Lazily parse the decoded data of a content stream, yielding
+    (operands, operator) for each q, Q, cm, m, l and c operation, where the
+    operands are strings of numbers.
+
+    All other operations are skipped without building PyPDF2 objects.'''
+
+    operands = []
+    pos = 0
+    end = len(data)
+
+    while pos < end:
+        match = TOKEN_RE.match(data, pos)
+        if match is None:
+            if SKIP_RE.match(data, pos).end() == end:
+                break
+            raise PdfReadError('unexpected content stream data at %d: %r' %
+                    (pos, data[pos:pos+20]))
+
+        pos = match.end()
+        kind = match.lastgroup
+
+        if kind == 'number':
+            operands.append(match.group(kind))
+
+        elif kind == 'operator':
+            operator = match.group(kind)
+
+            if operator in PATH_OPERATORS:
+                yield (operands, operator)
+
+            elif operator == 'BI':
+                # skip the inline image settings and data
+                image_start = INLINE_IMAGE_START_RE.search(data, pos)
+                if image_start is None:
+                    raise PdfReadError('unterminated inline image')
+                image_end = INLINE_IMAGE_END_RE.search(data, image_start.end())
+                if image_end is None:
+                    raise PdfReadError('unterminated inline image')
+                pos = image_end.end()
+
+            operands = []
+
+        elif kind == 'string':
+            # skip a literal string, allowing for escapes and nested brackets
+            depth = 1
+            while depth > 0:
+                token = STRING_RE.search(data, pos)
+                if token is None:
+                    raise PdfReadError('unterminated string')
+                pos = token.end()
+                if token.group() == '(':
+                    depth += 1
+                elif token.group() == ')':
+                    depth -= 1
+            operands.append(None)
+
+        else:
+            operands.append(None)
 
 def line_ops_to_lines(ops):
     lines = []
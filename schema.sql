@@ -4,5 +4,57 @@ create table uploaded (
     original_filename text not null,
     state integer not null,
     error_msg text,
-    time_taken real
+    time_taken real,
+    claim_token text,
+    lease_expires real,
+    attempts integer not null default 0,
+    content_hash text,
+    library_version text,
+    file_size integer,
+    page_count integer,
+    trailer_ok integer,
+    result_hash text,
+    created real
 );
+create index uploaded_content_hash on uploaded (content_hash, library_version);
+-- the rowid is part of every index, so this supports claiming the oldest
+-- item in a state
+create index uploaded_state on uploaded (state);
+
+drop table if exists page_tasks;
+create table page_tasks (
+    id integer primary key autoincrement,
+    upload_id integer not null references uploaded(id),
+    first_page integer not null,
+    end_page integer not null,
+    state integer not null,
+    error_msg text,
+    result text,
+    claim_token text,
+    lease_expires real,
+    attempts integer not null default 0
+);
+create index page_tasks_state on page_tasks (state);
+create index page_tasks_upload on page_tasks (upload_id, state);
+
+-- deleted uploads, moved out of the uploaded table by dbaccess.apply_retention()
+drop table if exists uploaded_archive;
+create table uploaded_archive (
+    id integer primary key,
+    original_filename text not null,
+    state integer not null,
+    time_taken real,
+    created real,
+    archived real not null
+);
+
+-- when periodic tasks such as dbaccess.apply_retention() were last run
+drop table if exists maintenance;
+create table maintenance (
+    name text primary key,
+    last_run real not null
+);
+insert into maintenance (name, last_run) values ('retention', 0);
+
+-- the number of migrations in dbaccess.MIGRATIONS that this schema includes
+pragma user_version = 2;
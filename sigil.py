@@ -1,4 +1,10 @@
+import cPickle
+import hashlib
+import io
 import json
+import os
+
+from optrie import SignatureTrie
 
 try:
     import numpy
@@ -21,6 +27,10 @@ class Sigil(object):
         self.ops = ops
         self.char = char
 
+        # numpy arrays of the ops, used for batched direction checks
+        if numpy is not None:
+            self.vectors, self.norms = ops_vectors(ops)
+
         self.angle = angle
 
         x1, x2, y1, y2 = ops_bb(ops)
@@ -80,6 +90,9 @@ class Sigil(object):
 
         self.scale = ops_scale(self.ops)
 
+        if numpy is not None:
+            self.vectors, self.norms = ops_vectors(self.ops)
+
         x1, x2, _, _ = ops_bb(self.ops)
         self.width = x2 - x1
 
@@ -93,7 +106,65 @@ class Sigil(object):
         return 'Sigil({!r}, {})'.format(self.char, ops_str)
 
 
+# increment whenever the contents of a compiled SigilDict change, so that old
+# cache files are regenerated
+CACHE_VERSION = 2
+
 class SigilDict(dict):
+    def __init__(self, *args, **kwargs):
+        super(SigilDict, self).__init__(*args, **kwargs)
+
+        # set by compile()
+        self.compiled_sigils = None
+        self.compiled_trie = None
+
+        # set by load(), see library_version()
+        self.version = None
+
+    @staticmethod
+    def load(json_filename, cache_filename=None):
+        '''Load a compiled SigilDict from json_filename.
+
+        The compiled SigilDict is cached in cache_filename (by default,
+        json_filename + '.cache'), keyed by a hash of the JSON, and is
+        regenerated automatically when the JSON changes.'''
+
+        if cache_filename is None:
+            cache_filename = json_filename + '.cache'
+
+        json_data = open(json_filename, 'rb').read()
+        json_hash = library_version(json_data)
+
+        try:
+            with open(cache_filename, 'rb') as f:
+                version, cached_hash, result = cPickle.load(f)
+
+            if version == CACHE_VERSION and cached_hash == json_hash:
+                result.version = json_hash
+                return result
+
+        except Exception:
+            # missing or corrupt cache: fall through to regenerate it
+            pass
+
+        result = SigilDict.from_json(io.BytesIO(json_data))
+        result.compile()
+        result.version = json_hash
+
+        # write to a temporary file first so that concurrent loads never see
+        # a partial cache
+        tmp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as f:
+                cPickle.dump((CACHE_VERSION, json_hash, result), f,
+                        cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, cache_filename)
+        except (IOError, OSError):
+            # can't write the cache, eg read-only directory
+            pass
+
+        return result
+
     @staticmethod
     def from_json(json_file):
         result = SigilDict()
@@ -110,10 +181,122 @@ class SigilDict(dict):
         json.dump({k: [s.to_dict() for s in v] for (k, v) in self.items()},
                 json_file, sort_keys=True, indent=4)
 
+    def compile(self):
+        '''Precompute the rotated copies of every sigil and the SignatureTrie
+        used to search for them. The SigilDict must not be modified
+        afterwards.'''
+
+        self.compiled_sigils = None
+        self.compiled_sigils = self.all_sigils()
+        self.compiled_trie = SignatureTrie(self.compiled_sigils)
+
+    def all_sigils(self):
+        '''Return a list of every sigil, combined with copies rotated by -90
+        degrees.'''
+
+        if self.compiled_sigils is not None:
+            return self.compiled_sigils
+
+        all_sigils = sum(self.values(), [])
+        return all_sigils + [sig.rotated(-90) for sig in all_sigils]
+
+    def signature_trie(self):
+        '''Return a SignatureTrie of the sigils returned by all_sigils().'''
+
+        if self.compiled_trie is not None:
+            return self.compiled_trie
+
+        return SignatureTrie(self.all_sigils())
+
+def library_version(json_data):
+    '''Return a string identifying the contents of a sigil library JSON
+    file.'''
+
+    return hashlib.sha1(json_data).hexdigest()
+
+class LineOps(object):
+    '''A compact list of ops, stored as an Nx2 array of coordinates and a
+    string of opcodes. It can be indexed and iterated like a list of
+    ((x, y), opcode) tuples, and slicing returns a LineOps viewing the same
+    coordinates.'''
+
+    def __init__(self, coords, opcodes):
+        self.coords = coords
+        self.opcodes = opcodes
+
+    @staticmethod
+    def from_list(ops):
+        if numpy is None:
+            raise NotImplementedError('LineOps requires numpy')
+
+        coords = numpy.array([coords for (coords, _) in ops],
+                dtype=float).reshape(-1, 2)
+        return LineOps(coords, ''.join(opcode for (_, opcode) in ops))
+
+    def remove_zero_ops(self, tol=0.01):
+        '''Vectorized version of remove_zero_ops().'''
+
+        assert self.opcodes[0] == 'm'
+
+        coords = self.coords
+        steps = coords[1:] - coords[:-1]
+        step_n2 = steps[:, 0]**2 + steps[:, 1]**2
+
+        # an op following a kept op is kept iff it is longer than tol, so only
+        # the ops after a removed op need to be checked one by one against
+        # the last kept op
+        keep = numpy.ones(len(self), dtype=bool)
+        next_i = 0
+
+        for i in (numpy.flatnonzero(step_n2 <= tol ** 2) + 1).tolist():
+            if i < next_i:
+                continue
+
+            keep[i] = False
+            px, py = coords[i-1].tolist()
+
+            j = i + 1
+            while j < len(self):
+                x, y = coords[j].tolist()
+                if (x-px) ** 2 + (y-py) ** 2 > tol ** 2:
+                    break
+
+                keep[j] = False
+                j += 1
+
+            # op j is kept, so the ops after it follow the usual rule
+            next_i = j + 1
+
+        opcodes = numpy.frombuffer(self.opcodes, dtype='S1')[keep].tostring()
+        return LineOps(coords[keep], opcodes)
+
+    def diff_ops(self):
+        '''Vectorized version of diff_ops().'''
+
+        assert self.opcodes[0] == 'm'
+
+        return LineOps(self.coords[1:] - self.coords[:-1], self.opcodes[1:])
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return LineOps(self.coords[key], self.opcodes[key])
+
+        x, y = self.coords[key].tolist()
+        return ((x, y), self.opcodes[key])
+
+    def __iter__(self):
+        return iter(zip(map(tuple, self.coords.tolist()), self.opcodes))
+
 def remove_zero_ops(ops, tol=0.01):
     '''Given a list of absolute ops, remove all ops with a length of less than
     tol (0.01 by default).'''
 
+    if isinstance(ops, LineOps):
+        return ops.remove_zero_ops(tol)
+
     assert ops[0][1] == 'm'
     px, py = ops[0][0]
 
@@ -132,6 +315,9 @@ def remove_zero_ops(ops, tol=0.01):
 def diff_ops(ops):
     '''Convert a list of absolute ops (eg from a PDF) to differential ops,
     by subtracting the coords of the first 'm' op.'''
+    if isinstance(ops, LineOps):
+        return ops.diff_ops()
+
     assert ops[0][1] == 'm'
     px, py = ops[0][0]
 
@@ -177,6 +363,22 @@ def ops_height(ops):
     _, _, min_y, max_y = ops_bb(ops)
     return max_y - min_y
 
+def ops_vectors(ops):
+    '''Given a differential ops list, return an Nx2 numpy array of the
+    coordinates of each op, and an array of their lengths.'''
+
+    if numpy is None:
+        raise NotImplementedError('ops_vectors() requires numpy')
+
+    if isinstance(ops, LineOps):
+        vectors = ops.coords
+    else:
+        vectors = numpy.array([coords for (coords, _) in ops],
+                dtype=float).reshape(-1, 2)
+    norms = numpy.sqrt(vectors[:, 0]*vectors[:, 0] + vectors[:, 1]*vectors[:, 1])
+
+    return vectors, norms
+
 def ops_scale(ops):
     '''Get an arbitrary number indicating the scale of the sigil,
     given some differential operations.
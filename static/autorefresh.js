@@ -1,4 +1,33 @@
-function refresh() {
-    window.location.reload(true);
+// Poll the state of the upload, and update the page in place when it changes.
+// Polls start frequently and back off, since large PDFs take a while, but
+// never wait longer than the old 5 second refresh.
+var MIN_DELAY = 1000;
+var MAX_DELAY = 5000;
+
+function pollStatus(delay) {
+    setTimeout(function() {
+        var status = $('#status');
+        var state = status.data('state');
+
+        // the server only renders the HTML if the state has changed
+        $.getJSON(status.data('json-url'), {state: state})
+            .done(function(data) {
+                var nextDelay = Math.min(delay * 1.5, MAX_DELAY);
+
+                if (data.state != state) {
+                    status.data('state', data.state);
+                    status.html(data.html);
+                    nextDelay = MIN_DELAY;
+                }
+
+                if (data.waiting) {
+                    pollStatus(nextDelay);
+                }
+            })
+            .fail(function() {
+                // the server may be restarting, so try again later
+                pollStatus(MAX_DELAY);
+            });
+    }, delay);
 }
-setTimeout(refresh, 5000);
+pollStatus(MIN_DELAY);
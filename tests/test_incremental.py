@@ -0,0 +1,235 @@
+'''Round-trip tests for SchematicReader.write_incremental_update(), on
+documents with a classic xref table, an xref stream and an object stream.
+
+Run from the top directory with: python -m unittest discover tests'''
+
+import io
+import json
+import os
+import re
+import struct
+import unittest
+from collections import namedtuple
+
+import PyPDF2
+from PyPDF2.generic import readObject
+
+import pdf
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# the parts of a sigil that add_text() uses
+Sigil = namedtuple('Sigil', ['char', 'angle'])
+
+CONTENT = '10 10 m 100 10 l 100 50 l S\n'
+
+OBJECTS = {
+    1: '<< /Type /Catalog /Pages 2 0 R >>',
+    2: '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+    3: '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 200] '
+        '/Resources 5 0 R /Contents 4 0 R >>',
+    4: '<< /Length %d >>\nstream\n%sendstream' % (len(CONTENT), CONTENT),
+    5: '<< /ProcSet [/PDF] >>',
+    }
+
+def write_objects(out, objects):
+    offsets = {}
+    for idnum in sorted(objects):
+        offsets[idnum] = len(out[0])
+        out[0] += '%d 0 obj\n%s\nendobj\n' % (idnum, objects[idnum])
+    return offsets
+
+def make_xref_table_pdf():
+    out = ['%PDF-1.4\n']
+    offsets = write_objects(out, OBJECTS)
+
+    xref_location = len(out[0])
+    out[0] += 'xref\n0 6\n0000000000 65535 f\r\n'
+    for idnum in range(1, 6):
+        out[0] += '%010d 00000 n\r\n' % offsets[idnum]
+    out[0] += 'trailer\n<< /Size 6 /Root 1 0 R >>\n'
+    out[0] += 'startxref\n%d\n%%%%EOF\n' % xref_location
+
+    return out[0]
+
+def write_xref_stream(out, idnum, entries):
+    '''Write an xref stream for objects 0 to idnum, given the (type, field2,
+    field3) entry of each object before it.'''
+
+    xref_location = len(out[0])
+    data = ''.join(struct.pack('>BIH', *entry)
+            for entry in entries + [(1, xref_location, 0)])
+    out[0] += ('%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Root 1 0 R '
+            '/Length %d >>\nstream\n%s\nendstream\nendobj\n' %
+            (idnum, idnum + 1, len(data), data))
+    out[0] += 'startxref\n%d\n%%%%EOF\n' % xref_location
+
+def make_xref_stream_pdf():
+    out = ['%PDF-1.5\n']
+    offsets = write_objects(out, OBJECTS)
+
+    write_xref_stream(out, 6,
+            [(0, 0, 65535)] + [(1, offsets[i], 0) for i in range(1, 6)])
+
+    return out[0]
+
+def make_object_stream_pdf():
+    '''Objects other than the content stream are in object stream 6.'''
+
+    out = ['%PDF-1.5\n']
+    offsets = write_objects(out, {4: OBJECTS[4]})
+
+    compressed = [1, 2, 3, 5]
+    body = ''
+    header = []
+    for idnum in compressed:
+        header.append('%d %d' % (idnum, len(body)))
+        body += OBJECTS[idnum] + '\n'
+    header = ' '.join(header) + '\n'
+    offsets.update(write_objects(out, {6:
+        '<< /Type /ObjStm /N %d /First %d /Length %d >>\nstream\n%s%s\nendstream' %
+        (len(compressed), len(header), len(header + body), header, body)}))
+
+    entries = [(0, 0, 65535)]
+    for idnum in range(1, 7):
+        if idnum in compressed:
+            entries.append((2, 6, compressed.index(idnum)))
+        else:
+            entries.append((1, offsets[idnum], 0))
+    write_xref_stream(out, 7, entries)
+
+    return out[0]
+
+def read_update(data):
+    '''Parse the last xref section of a document, returning its location,
+    its trailer (or xref stream) dictionary and a dict mapping the object
+    numbers in it to their offsets.'''
+
+    xref_location = int(re.findall(r'startxref\s+(\d+)', data)[-1])
+    stream = io.BytesIO(data)
+    offsets = {}
+
+    if data[xref_location:].startswith('xref'):
+        table, trailer_data = data[xref_location:].split('trailer', 1)
+        lines = table.split('\n')[1:]
+        i = 0
+        while lines[i].strip():
+            start, count = map(int, lines[i].split())
+            for idnum in range(start, start + count):
+                offset, generation, kind = lines[i + 1 + idnum - start].split()
+                if kind == 'n':
+                    offsets[idnum] = int(offset)
+            i += 1 + count
+
+        stream.seek(data.index('<<', xref_location + len(table)))
+        trailer = readObject(stream, None)
+    else:
+        stream.seek(data.index('<<', xref_location))
+        trailer = readObject(stream, None)
+
+        widths = [int(w) for w in trailer['/W']]
+        index = [int(n) for n in trailer['/Index']]
+        entries = trailer.getData()
+        entry_size = sum(widths)
+
+        ids = [idnum for (start, count) in zip(index[::2], index[1::2])
+                for idnum in range(start, start + count)]
+        for n, idnum in enumerate(ids):
+            entry = entries[n * entry_size:(n + 1) * entry_size]
+            assert widths == [1, 4, 2]
+            kind, offset, _ = struct.unpack('>BIH', entry)
+            if kind == 1:
+                offsets[idnum] = offset
+
+    return xref_location, trailer, offsets
+
+class IncrementalUpdateTest(object):
+    '''Checks for each kind of document, which subclasses provide with
+    make_pdf() and original_size.'''
+
+    def setUp(self):
+        self.original = self.make_pdf()
+
+        font_map = json.load(open(os.path.join(ROOT, 'font_map.json')))
+        donor_data = open(os.path.join(ROOT, 'font_donor.pdf'), 'rb').read()
+
+        rdr = pdf.SchematicReader(io.BytesIO(self.original), font_map=font_map)
+        self.font = rdr.add_dummy_font(donor_data)
+        rdr.add_text(0, self.font, [
+            (Sigil('A', 0), (20, 20), 1.0),
+            (Sigil('B', 0), (30, 20), 1.0),
+            ])
+
+        out = io.BytesIO()
+        rdr.write_incremental_update(out)
+        self.updated = out.getvalue()
+
+    def test_keeps_original(self):
+        self.assertTrue(self.updated.startswith(self.original))
+
+    def test_pages(self):
+        rdr = PyPDF2.PdfFileReader(io.BytesIO(self.updated))
+        self.assertEqual(rdr.getNumPages(), 1)
+
+        page = rdr.getPage(0)
+        self.assertIn(self.font, page['/Resources']['/Font'])
+
+        # the original contents are wrapped in q/Q, followed by the text
+        data = ''.join(s.getObject().getData() for s in page['/Contents'])
+        self.assertIn(CONTENT, data)
+        self.assertIn('TJ', data)
+        self.assertLess(data.index(CONTENT), data.index('TJ'))
+
+    def test_prev(self):
+        _, trailer, _ = read_update(self.updated)
+        original_xref = int(re.findall(r'startxref\s+(\d+)', self.original)[-1])
+        self.assertEqual(trailer['/Prev'], original_xref)
+        self.assertEqual(trailer.raw_get('/Root').idnum, 1)
+
+    def test_offsets(self):
+        _, _, offsets = read_update(self.updated)
+        for idnum, offset in offsets.items():
+            self.assertTrue(self.updated.startswith('%d 0 obj' % idnum, offset),
+                    'wrong offset for object %d' % idnum)
+
+    def test_modified_objects(self):
+        # the page, with its new contents, and the resources, with the font
+        _, _, offsets = read_update(self.updated)
+        self.assertIn(3, offsets)
+        self.assertIn(5, offsets)
+        self.assertNotIn(4, offsets)
+
+    def test_new_object_ids(self):
+        _, trailer, offsets = read_update(self.updated)
+        new_ids = sorted(idnum for idnum in offsets if idnum not in OBJECTS)
+
+        self.assertEqual(new_ids[0], self.original_size)
+        self.assertEqual(new_ids, range(self.original_size, trailer['/Size']))
+
+class XrefTableTest(IncrementalUpdateTest, unittest.TestCase):
+    make_pdf = staticmethod(make_xref_table_pdf)
+    original_size = 6
+
+    def test_xref_table(self):
+        xref_location, _, _ = read_update(self.updated)
+        self.assertTrue(self.updated.startswith('xref', xref_location))
+
+class XrefStreamTest(IncrementalUpdateTest, unittest.TestCase):
+    make_pdf = staticmethod(make_xref_stream_pdf)
+    original_size = 7
+
+    def test_index(self):
+        xref_location, trailer, offsets = read_update(self.updated)
+        self.assertEqual(trailer['/Type'], '/XRef')
+        self.assertEqual(trailer['/Index'], pdf.xref_subsections(sorted(offsets)))
+
+        # the xref stream lists itself
+        self.assertEqual(offsets[trailer['/Size'] - 1], xref_location)
+
+class ObjectStreamTest(XrefStreamTest):
+    make_pdf = staticmethod(make_object_stream_pdf)
+    original_size = 8
+
+    def test_original_is_compressed(self):
+        rdr = PyPDF2.PdfFileReader(io.BytesIO(self.original))
+        self.assertEqual(sorted(rdr.xref_objStm), [1, 2, 3, 5])
@@ -0,0 +1,155 @@
+'''Tests for claiming work items with leases, and requeuing them when the
+leases expire.'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import dbaccess
+from dbaccess import State
+import worker
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'schema.sql')
+
+class LeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_paths = (worker.DATABASE, worker.MATCH_CACHE)
+        worker.DATABASE = os.path.join(self.directory, 'scheming.db')
+        worker.MATCH_CACHE = os.path.join(self.directory, 'match_cache')
+
+        dbaccess.init_db(worker.DATABASE, SCHEMA)
+        self.db = dbaccess.connect_db(worker.DATABASE)
+
+        # two workers with their own connections, without the wakeup FIFO
+        self.workers = [worker.Worker(), worker.Worker()]
+        for w in self.workers:
+            w.db = dbaccess.connect_db(worker.DATABASE)
+
+    def tearDown(self):
+        for w in self.workers:
+            w.db.close()
+        self.db.close()
+        worker.DATABASE, worker.MATCH_CACHE = self.old_paths
+        shutil.rmtree(self.directory)
+
+    def add_upload(self, state=State.New, **columns):
+        columns = dict(original_filename='test.pdf', state=state,
+                created=time.time(), **columns)
+        cur = self.db.execute('insert into uploaded ({}) values ({})'.format(
+                ', '.join(columns), ', '.join('?' * len(columns))), columns.values())
+        self.db.commit()
+        return cur.lastrowid
+
+    def get_upload(self, id):
+        return self.db.execute('select * from uploaded where id = ?', [id]).fetchone()
+
+    def test_claim(self):
+        id = self.add_upload()
+
+        before = time.time()
+        row, claim_token = self.workers[0].claim()
+
+        self.assertEqual(row['id'], id)
+        self.assertEqual(row['state'], State.Working)
+        self.assertEqual(row['claim_token'], claim_token)
+        self.assertEqual(row['attempts'], 1)
+        self.assertGreaterEqual(row['lease_expires'], before + worker.LEASE_DURATION)
+
+    def test_claim_oldest(self):
+        ids = [self.add_upload() for _ in range(3)]
+        claimed = [self.workers[i % 2].claim()[0]['id'] for i in range(3)]
+
+        self.assertEqual(claimed, ids)
+        self.assertIsNone(self.workers[0].claim())
+
+    def test_claim_once(self):
+        self.add_upload()
+
+        self.assertIsNotNone(self.workers[0].claim())
+        self.assertIsNone(self.workers[1].claim())
+
+    def test_claim_only_new(self):
+        for state in [State.Working, State.Failed, State.Succeeded,
+                State.Deleted, State.Uploading, State.Deleting]:
+            self.add_upload(state)
+
+        self.assertIsNone(self.workers[0].claim())
+
+    def test_claim_condition(self):
+        upload_ids = [self.add_upload(State.Working) for _ in range(2)]
+        for upload_id in upload_ids:
+            self.db.execute('insert into page_tasks (upload_id, first_page, end_page, state) '
+                    'values (?, 0, 5, ?)', [upload_id, State.New])
+        self.db.commit()
+
+        row, _ = self.workers[0].claim('page_tasks', 'upload_id = ?', [upload_ids[1]])
+        self.assertEqual(row['upload_id'], upload_ids[1])
+        self.assertIsNone(self.workers[0].claim('page_tasks', 'upload_id = ?', [upload_ids[1]]))
+
+    def test_requeue_expired(self):
+        expired = self.add_upload(State.Working, claim_token='a',
+                lease_expires=time.time() - 1, attempts=1)
+        current = self.add_upload(State.Working, claim_token='b',
+                lease_expires=time.time() + worker.LEASE_DURATION, attempts=1)
+
+        self.workers[0].requeue_expired()
+
+        row = self.get_upload(expired)
+        self.assertEqual(row['state'], State.New)
+        self.assertIsNone(row['claim_token'])
+
+        row = self.get_upload(current)
+        self.assertEqual(row['state'], State.Working)
+        self.assertEqual(row['claim_token'], 'b')
+
+        # the requeued upload can be claimed again, counting another attempt
+        row, _ = self.workers[1].claim()
+        self.assertEqual(row['id'], expired)
+        self.assertEqual(row['attempts'], 2)
+
+    def test_fail_after_max_attempts(self):
+        id = self.add_upload(State.Working, claim_token='a',
+                lease_expires=time.time() - 1, attempts=worker.MAX_ATTEMPTS)
+
+        self.workers[0].requeue_expired()
+
+        row = self.get_upload(id)
+        self.assertEqual(row['state'], State.Failed)
+        self.assertIsNone(row['claim_token'])
+        self.assertIsNotNone(row['error_msg'])
+
+    def test_requeued_lease_is_lost(self):
+        # a worker whose lease expired can't extend it once the item is
+        # requeued, even if another worker hasn't claimed it yet
+        self.add_upload()
+        row, claim_token = self.workers[0].claim()
+        self.db.execute('update uploaded set lease_expires = ?', [time.time() - 1])
+        self.db.commit()
+        self.workers[1].requeue_expired()
+
+        cur = self.db.execute('update uploaded set lease_expires = ? '
+                'where id = ? and claim_token = ?',
+                [time.time() + worker.LEASE_DURATION, row['id'], claim_token])
+        self.assertEqual(cur.rowcount, 0)
+
+    def test_heartbeat(self):
+        self.add_upload()
+        row, claim_token = self.workers[0].claim()
+        self.db.execute('update uploaded set lease_expires = ?', [time.time()])
+        self.db.commit()
+
+        old_interval = worker.HEARTBEAT_INTERVAL
+        worker.HEARTBEAT_INTERVAL = 0.01
+        try:
+            heartbeat = worker.Heartbeat('uploaded', row['id'], claim_token)
+            heartbeat.start()
+            time.sleep(0.1)
+            heartbeat.stop()
+        finally:
+            worker.HEARTBEAT_INTERVAL = old_interval
+
+        row = self.get_upload(row['id'])
+        self.assertGreater(row['lease_expires'], time.time() + worker.LEASE_DURATION / 2)
@@ -0,0 +1,69 @@
+'''Tests for combining characters into TJ operators with pdf.TextRun.'''
+
+import unittest
+
+import pdf
+
+# a text matrix with a scale of 10 units of user space per unit of text space
+MATRIX = ['10', '0', '0', '10']
+
+WIDTHS = pdf.DefaultWidths({1: 500, 2: 600}, default=1000)
+
+class TextRunTest(unittest.TestCase):
+    def test_single_character(self):
+        run = pdf.TextRun(MATRIX, 0, 0, 1, WIDTHS)
+        self.assertEqual(run.to_data(), '[<0001>] TJ')
+
+    def test_adjacent_characters(self):
+        # the second character starts at the end of the first, 0.5 units of
+        # text space along
+        run = pdf.TextRun(MATRIX, 0, 0, 1, WIDTHS)
+        self.assertTrue(run.try_to_add(MATRIX, 5, 0, 2, WIDTHS))
+        self.assertEqual(run.to_data(), '[<00010002>] TJ')
+
+    def test_kerning(self):
+        # a gap of 0.25 units moves the next character forwards, and an
+        # overlap of 0.1 units moves it backwards
+        run = pdf.TextRun(MATRIX, 0, 0, 1, WIDTHS)
+        self.assertTrue(run.try_to_add(MATRIX, 7.5, 0, 2, WIDTHS))
+        self.assertTrue(run.try_to_add(MATRIX, 12.5, 0, 1, WIDTHS))
+        self.assertEqual(run.to_data(), '[<0001> -250 <0002> 100 <0001>] TJ')
+
+    def test_kerning_accumulates(self):
+        # offsets too small to kern are carried over to the next character,
+        # so the characters don't drift away from their positions
+        run = pdf.TextRun(MATRIX, 0, 0, 1, WIDTHS)
+        for i in range(1, 10):
+            self.assertTrue(run.try_to_add(MATRIX, i * 5.0012, 0, 1, WIDTHS))
+        self.assertEqual(run.to_data(),
+                '[<00010001000100010001> -1 <00010001000100010001>] TJ')
+
+    def test_default_width(self):
+        run = pdf.TextRun(MATRIX, 0, 0, 3, WIDTHS)
+        self.assertTrue(run.try_to_add(MATRIX, 10, 0, 1, WIDTHS))
+        self.assertEqual(run.to_data(), '[<00030001>] TJ')
+
+    def test_rotated(self):
+        # text running up the page, as for sigils at an angle of -90
+        matrix = ['0', '10', '-10', '0']
+        run = pdf.TextRun(matrix, 0, 0, 1, WIDTHS)
+        self.assertFalse(run.try_to_add(matrix, 5, 0, 2, WIDTHS))
+        self.assertTrue(run.try_to_add(matrix, 0, 5, 2, WIDTHS))
+        self.assertEqual(run.to_data(), '[<00010002>] TJ')
+
+    def test_different_matrix(self):
+        run = pdf.TextRun(MATRIX, 0, 0, 1, WIDTHS)
+        self.assertFalse(run.try_to_add(['12', '0', '0', '12'], 5, 0, 2, WIDTHS))
+
+    def test_different_baseline(self):
+        run = pdf.TextRun(MATRIX, 0, 0, 1, WIDTHS)
+        self.assertFalse(run.try_to_add(MATRIX, 5, 0.1, 2, WIDTHS))
+
+    def test_too_far(self):
+        run = pdf.TextRun(MATRIX, 0, 0, 1, WIDTHS)
+        self.assertFalse(run.try_to_add(MATRIX, 5 + 10 * pdf.MAX_TJ_GAP + 0.1, 0, 2, WIDTHS))
+
+    def test_backwards(self):
+        run = pdf.TextRun(MATRIX, 0, 0, 1, WIDTHS)
+        self.assertFalse(run.try_to_add(MATRIX, 0, 0, 2, WIDTHS))
+        self.assertFalse(run.try_to_add(MATRIX, -5, 0, 2, WIDTHS))
@@ -0,0 +1,61 @@
+'''Wakes idle workers as soon as work is added to the database, using a named
+pipe (FIFO). Each byte written to the pipe wakes one idle worker.'''
+
+import errno
+import os
+import select
+
+def notify(fifo_path):
+    '''Wake an idle worker. Does nothing if no worker is listening, since
+    workers also poll the database occasionally.'''
+
+    try:
+        fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        # no FIFO or no workers listening
+        return
+
+    try:
+        os.write(fd, '\n')
+    except OSError as e:
+        # if the pipe is full, the workers already have plenty to wake for
+        if e.errno != errno.EAGAIN:
+            raise
+    finally:
+        os.close(fd)
+
+class Listener(object):
+    '''Waits for notify() to be called by another process.'''
+
+    def __init__(self, fifo_path):
+        try:
+            os.mkfifo(fifo_path, 0o660)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # open for writing too, so that the pipe never signals end-of-file
+        # when there are no notifiers
+        self.fd = os.open(fifo_path, os.O_RDWR | os.O_NONBLOCK)
+
+    def wait(self, timeout):
+        '''Wait until notified, or until timeout seconds have passed.
+
+        Returns True iff notified.'''
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+
+        if len(readable) == 0:
+            return False
+
+        try:
+            os.read(self.fd, 1)
+        except OSError as e:
+            # another worker took the notification first
+            if e.errno != errno.EAGAIN:
+                raise
+
+        return True
+
+    def close(self):
+        os.close(self.fd)
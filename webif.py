@@ -1,9 +1,17 @@
+import errno
 import os
-from flask import Flask, abort, g, render_template, request, redirect, send_from_directory, url_for
+import threading
+import time
+from flask import Flask, Request, Response, abort, current_app, g, jsonify, render_template, request, redirect, url_for
 from werkzeug import secure_filename
+from werkzeug.datastructures import ContentRange
 from dbaccess import State, connect_db
+import ingest
+import sigil
+import wakeup
 
 ALLOWED_EXTENSIONS = set(['pdf'])
+CHUNK_SIZE = 64 * 1024 # number of bytes to read or write at a time
 
 BASE_PATH = '/usr/local/scheming'
 
@@ -12,9 +20,39 @@ app.config.update({
     'UPLOAD_FOLDER': os.path.join(BASE_PATH, 'uploads/'),
     'RESULT_FOLDER': os.path.join(BASE_PATH, 'results/'),
     'DATABASE': os.path.join(BASE_PATH, 'scheming.db'),
+    'WAKEUP_FIFO': os.path.join(BASE_PATH, 'wakeup.fifo'),
+    'SIGIL_LIBRARY': 'scheming.json',
+    'MAX_CONTENT_LENGTH': 200 * 1024 * 1024,
+    # the number of days after which uploads are deleted automatically, to
+    # tell users on the status page. Set it to match the workers'
+    # --retention-days, or None if they keep uploads.
+    'RETENTION_DAYS': None,
+    # set to 'X-Sendfile' or 'X-Accel-Redirect' to let the front end server
+    # send results. For X-Accel-Redirect, RESULT_ACCEL_PREFIX is the internal
+    # location that maps to RESULT_FOLDER.
+    'RESULT_SENDFILE': None,
+    'RESULT_ACCEL_PREFIX': '/results/',
     'DEBUG': True,
 })
 
+class UploadRequest(Request):
+    '''Streams uploaded files straight into the upload folder, instead of
+    buffering them in memory or a temporary file (see ingest.UploadFile).'''
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+            content_length=None):
+        upload = ingest.UploadFile(current_app.config['UPLOAD_FOLDER'],
+                current_app.config['MAX_CONTENT_LENGTH'])
+
+        # deleted at the end of the request unless it is moved into place
+        if not hasattr(g, 'uploads'):
+            g.uploads = []
+        g.uploads.append(upload)
+
+        return upload
+
+app.request_class = UploadRequest
+
 def get_db():
     """Opens a new database connection if there is none yet for the
     current application context.
@@ -29,6 +67,12 @@ def close_db(error):
     if hasattr(g, 'sqlite_db'):
         g.sqlite_db.close()
 
+@app.teardown_appcontext
+def discard_uploads(error):
+    """Deletes any uploaded files that weren't used."""
+    for upload in g.get('uploads', []):
+        upload.discard()
+
 def header(title):
     return '''
     <!doctype html>
@@ -60,56 +104,245 @@ def upload_file():
     db = get_db()
 
     if request.method == 'POST':
-        file = request.files['file']
+        try:
+            file = request.files['file']
+        except ingest.UploadTooLarge:
+            abort(413)
+
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
 
-            cur = db.execute('insert into uploaded (original_filename, state) values (?, ?)',
-                    [filename, State.Uploading])
+            upload = file.stream
+            properties = upload.finish()
+
+            cur = db.execute('insert into uploaded (original_filename, state, created, '
+                    'content_hash, file_size, page_count, trailer_ok) values (?, ?, ?, ?, ?, ?, ?)',
+                    [filename, State.Uploading, time.time(), properties['content_hash'],
+                        properties['file_size'], properties['page_count'],
+                        properties['trailer_ok']])
             db.commit()
             id = str(cur.lastrowid)
 
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], id+'.pdf'))
+            os.rename(upload.path, os.path.join(app.config['UPLOAD_FOLDER'], id+'.pdf'))
+
+            # don't bother the workers with files that obviously aren't PDFs
+            if not upload.is_pdf():
+                db.execute('update uploaded set state = ?, error_msg = ? where id = ?',
+                        [State.Failed, 'This file is not a PDF.', id])
+                db.commit()
+                return redirect(url_for('status', id=id))
+
+            if reuse_result(db, id, properties['content_hash']):
+                return redirect(url_for('status', id=id))
 
             db.execute('update uploaded set state = ? where id = ?', [State.New, id])
             db.commit()
 
+            wakeup.notify(app.config['WAKEUP_FIFO'])
+
             return redirect(url_for('status', id=id))
 
     return render_template('index.html',
             title='Searchable Schematics')
 
-@app.route('/status/<id>')
-def status(id):
-    db = get_db()
-    cur = db.execute('select state from uploaded where id = ?', [id])
-    states = cur.fetchall()
+def reuse_result(db, id, content_hash):
+    '''If the same file has already been processed successfully with the
+    current sigil library, hard link its result as the result of this upload
+    and mark it as succeeded.
+
+    Each upload has its own link to the result file, and the workers only
+    erase the data when no other remaining upload links to it (see
+    Worker.result_is_shared()), so deleting one upload doesn't affect the
+    others.
+
+    Returns True iff a result was reused.'''
+
+    library_version = sigil.library_version(open(app.config['SIGIL_LIBRARY'], 'rb').read())
+
+    # hold the write lock until this upload is marked as succeeded, so the
+    # other upload can't be marked for deletion (and its result erased)
+    # before the link is made and recorded
+    db.execute('begin immediate')
+
+    try:
+        cur = db.execute('select id, result_hash from uploaded where content_hash = ? '
+                'and library_version = ? and state = ? and result_hash is not null '
+                'order by id desc',
+                [content_hash, library_version, State.Succeeded])
+
+        for (other_id, result_hash) in cur.fetchall():
+            try:
+                os.link(os.path.join(app.config['RESULT_FOLDER'], str(other_id) + '.pdf'),
+                        os.path.join(app.config['RESULT_FOLDER'], id + '.pdf'))
+            except OSError as e:
+                # the result is missing, eg deleted by hand
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            db.execute('update uploaded set state = ?, library_version = ?, result_hash = ?, '
+                    'error_msg = ?, time_taken = ? where id = ?',
+                    [State.Succeeded, library_version, result_hash, '', 0, id])
+            db.commit()
+
+            return True
+
+    finally:
+        # release the lock if nothing was reused
+        db.rollback()
+
+    return False
 
-    if len(states) == 0:
+@app.route('/status/<int:id>')
+def status(id):
+    state = get_state(id)
+    if state is None:
         abort(404)
 
     return render_template('status.html',
             title='Searchable Schematics',
-            id=id, state=states[0][0], State=State)
+            id=id, state=state, State=State)
+
+@app.route('/status/<int:id>.json')
+def status_json(id):
+    '''Return the status of an upload as JSON, for autorefresh.js. If the
+    state argument is given, the HTML for the status page is only included
+    if the state has changed.'''
+
+    state = get_state(id)
+    if state is None:
+        abort(404)
+
+    known_state = request.args.get('state', type=int)
+
+    return state_to_json(id, state, include_html=(state != known_state))
+
+# connections used by get_state(), which are kept open between requests since
+# status pages are polled frequently
+status_connections = threading.local()
+
+def get_state(id):
+    '''Return the state of an upload, or None if it doesn't exist.'''
+
+    if not hasattr(status_connections, 'db'):
+        status_connections.db = connect_db(app.config['DATABASE'])
+
+    cur = status_connections.db.execute('select state from uploaded where id = ?', [id])
+    row = cur.fetchone()
+
+    if row is None:
+        return None
 
-@app.route('/result/<id>')
+    return row[0]
+
+def state_to_json(id, state, include_html=True):
+    '''Return a JSON response describing the state of an upload, optionally
+    including the HTML for the status page so that it can be updated in
+    place.'''
+
+    rv = dict(
+            id=id,
+            state=state,
+            state_name=STATE_NAMES[state],
+            waiting=state in (State.New, State.Working, State.Deleting))
+
+    if include_html:
+        rv['html'] = render_template('status_body.html', id=id, state=state, State=State)
+
+    return jsonify(**rv)
+
+STATE_NAMES = {value: name for (name, value) in vars(State).items()
+        if not name.startswith('_')}
+
+@app.route('/result/<int:id>')
 def result(id):
     db = get_db()
-    cur = db.execute('select state, original_filename from uploaded where id = ?', [id])
+    cur = db.execute('select state, original_filename, result_hash from uploaded where id = ?', [id])
     rows = cur.fetchall()
 
     if len(rows) == 0:
         abort(404)
 
-    state, original_filename = rows[0]
+    state, original_filename, result_hash = rows[0]
     new_filename = adjust_filename(original_filename)
 
     if state != State.Succeeded:
         return redirect(url_for('status', id=id))
 
-    return send_from_directory(
-            app.config['RESULT_FOLDER'], id + '.pdf',
-            as_attachment=True, attachment_filename=new_filename)
+    path = os.path.join(app.config['RESULT_FOLDER'], '{}.pdf'.format(id))
+
+    # the hash is recorded by the worker when the result is written, except
+    # for results written by older versions, which are hashed once here
+    if result_hash is None:
+        result_hash = ingest.hash_file(path)
+        db.execute('update uploaded set result_hash = ? where id = ? and state = ?',
+                [result_hash, id, State.Succeeded])
+        db.commit()
+
+    return send_result(path, result_hash, new_filename)
+
+def send_result(path, etag, attachment_filename):
+    '''Send a result file, using etag as a strong ETag. Supports conditional
+    requests and single byte ranges, or hands the file to the front end
+    server if RESULT_SENDFILE is set.'''
+
+    rv = Response(mimetype='application/pdf')
+    rv.headers.add('Content-Disposition', 'attachment',
+            filename=attachment_filename)
+    rv.set_etag(etag)
+
+    # If-None-Match uses the weak comparison, so W/"<etag>" matches too
+    if request.if_none_match.contains_weak(etag):
+        rv.status_code = 304
+        return rv
+
+    sendfile = app.config['RESULT_SENDFILE']
+    if sendfile == 'X-Sendfile':
+        rv.headers['X-Sendfile'] = os.path.abspath(path)
+        return rv
+    elif sendfile == 'X-Accel-Redirect':
+        rv.headers['X-Accel-Redirect'] = app.config['RESULT_ACCEL_PREFIX'] + os.path.basename(path)
+        return rv
+
+    rv.accept_ranges = 'bytes'
+    size = os.path.getsize(path)
+    start, end = 0, size
+
+    # only single ranges are supported, otherwise the whole file is sent.
+    # An If-Range header means the range only applies if the file is unchanged.
+    if (request.range is not None and len(request.range.ranges) == 1 and
+            (request.if_range.date is None and request.if_range.etag in (None, etag))):
+        byte_range = request.range.range_for_length(size)
+
+        if byte_range is None:
+            rv.status_code = 416
+            rv.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return rv
+
+        start, end = byte_range
+        rv.status_code = 206
+        rv.content_range = ContentRange('bytes', start, end, size)
+
+    rv.response = read_file_range(path, start, end)
+    rv.content_length = end - start
+    rv.direct_passthrough = True
+
+    return rv
+
+def read_file_range(path, start, end):
+    '''Yield the bytes of a file from start to end in chunks.'''
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+
+            remaining -= len(chunk)
+            yield chunk
 
 def adjust_filename(filename):
     '''Add '_searchable' to the filename to make it clear it's been
@@ -118,8 +351,10 @@ def adjust_filename(filename):
     root, ext = os.path.splitext(filename)
     return root + '_searchable' + ext
 
-@app.route('/delete/<id>', methods=['POST'])
+@app.route('/delete/<int:id>', methods=['POST'])
 def delete(id):
+    '''Mark an upload for deletion. The files are securely erased by a
+    worker in the background, see Worker.try_deletion().'''
 
     db = get_db()
     cur = db.execute('select state from uploaded where id = ?', [id])
@@ -130,27 +365,15 @@ def delete(id):
 
     state = rows[0][0]
 
-    if state == State.Succeeded:
-        secure_delete(os.path.join(app.config['UPLOAD_FOLDER'], id + '.pdf'))
-        secure_delete(os.path.join(app.config['RESULT_FOLDER'], id + '.pdf'))
-
-        db.execute('update uploaded set state = ? where id = ?', [State.Deleted, id])
+    # a failed deletion can be retried
+    if state in (State.Succeeded, State.DeletionFailed):
+        db.execute('update uploaded set state = ?, attempts = 0 where id = ? and state = ?',
+                [State.Deleting, id, state])
         db.commit()
 
-    return redirect(url_for('status', id=id))
-
-def secure_delete(path):
-    '''Overwrite a file with zeros before deleting it.'''
+        wakeup.notify(app.config['WAKEUP_FIFO'])
 
-    size = os.stat(path).st_size
-
-    f = open(path, 'w')
-    f.write('\0' * size)
-    f.flush()
-    os.fsync(f.fileno())
-    f.close()
-
-    os.remove(path)
+    return redirect(url_for('status', id=id))
 
 if __name__ == '__main__':
     app.run()
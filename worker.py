@@ -1,71 +1,229 @@
 import argparse
+import glob
+import json
+import multiprocessing
+import sqlite3
+import threading
 import time
 import traceback
 import os
+import uuid
 
-from dbaccess import connect_db, State
+from dbaccess import apply_retention, connect_db, State
 import annotate
+import erase
+import ingest
+import matchcache
+import pdf
+import wakeup
 
 BASE_PATH = '/usr/local/scheming'
 
 DATABASE = os.path.join(BASE_PATH, 'scheming.db')
 UPLOADS = os.path.join(BASE_PATH, 'uploads/')
 RESULTS = os.path.join(BASE_PATH, 'results/')
-CHECK_INTERVAL = 1 # number of seconds to wait between checking for work
+WAKEUP_FIFO = os.path.join(BASE_PATH, 'wakeup.fifo')
+MATCH_CACHE = os.path.join(BASE_PATH, 'match_cache/')
+MATCH_CACHE_SIZE = 500 * 1024 * 1024 # maximum number of bytes in the match cache
+CHECK_INTERVAL = 1 # number of seconds to wait between checking on worker processes
+POLL_INTERVAL = 30 # number of seconds to wait for work before checking anyway
+LEASE_DURATION = 60 # number of seconds a claimed work item is reserved for
+HEARTBEAT_INTERVAL = 10 # number of seconds between extensions of the lease
+MAX_ATTEMPTS = 3 # number of times a work item is tried before giving up
+SHARD_MIN_PAGES = 20 # uploads with at least this many pages are split up
+PAGES_PER_TASK = 5 # number of pages matched by each page task
+ARCHIVE_AGE = 30 * 24 * 60 * 60 # number of seconds before deleted uploads are archived
+RETENTION_INTERVAL = 60 * 60 # number of seconds between applying the retention policy
+
+# tables containing work items, all with state, claim_token, lease_expires and
+# attempts columns
+WORK_TABLES = ['uploaded', 'page_tasks']
 
 def main():
     parser = argparse.ArgumentParser(
             description='Processes work items that are added to the database by the web interface.')
+    parser.add_argument('--concurrency', '-c', type=int, default=1,
+            help='number of worker processes to run [default: 1]')
+    parser.add_argument('--retention-days', type=float, default=None,
+            help='delete uploads and their results this many days after they '
+            'were uploaded, which should match RETENTION_DAYS in the web '
+            'interface [default: keep them until users delete them]')
     args = parser.parse_args()
 
-    w = Worker()
+    retention_age = None
+    if args.retention_days is not None:
+        retention_age = args.retention_days * 24 * 60 * 60
+
+    if args.concurrency > 1:
+        supervise(args.concurrency, retention_age)
+    else:
+        run_worker(retention_age)
+
+def run_worker(retention_age=None):
+    w = Worker(retention_age)
     w.connect()
     w.work_loop()
 
+def supervise(concurrency, retention_age=None):
+    '''Run several worker processes, restarting any that die (eg if they are
+    killed for running out of memory). The work items they were processing
+    are requeued when their leases expire.'''
+
+    processes = []
+
+    while True:
+        processes = [p for p in processes if p.is_alive()]
+
+        while len(processes) < concurrency:
+            p = multiprocessing.Process(target=run_worker, args=(retention_age,))
+            p.daemon = True
+            p.start()
+            print 'Started worker process', p.pid
+            processes.append(p)
+
+        time.sleep(CHECK_INTERVAL)
+
 class Worker(object):
+    def __init__(self, retention_age=None):
+        # loaded once and reused for every work item
+        self.resources = annotate.Resources(
+                match_cache=matchcache.MatchCache(MATCH_CACHE, MATCH_CACHE_SIZE))
+
+        # number of seconds before uploads are deleted, or None to keep them
+        # until users delete them
+        self.retention_age = retention_age
+
+        # time of the last call to apply_retention()
+        self.retention_checked = 0
+
     def connect(self):
         self.db = connect_db(DATABASE)
 
+        # overwrite rows deleted by this connection in the database file, since
+        # page tasks contain text from the documents
+        self.db.execute('pragma secure_delete = on')
+
+        self.wakeup = wakeup.Listener(WAKEUP_FIFO)
+
     def work_loop(self):
-        '''Repeatedly try to do work items.'''
+        '''Repeatedly try to do work items. When idle, wait until the web
+        interface adds work, or until POLL_INTERVAL has passed.
+
+        Deleted uploads are archived every RETENTION_INTERVAL, by whichever
+        worker notices first, and old uploads are deleted if retention_age is
+        set (see apply_retention()).'''
+
+        self.hash_old_results()
 
         while True:
+            if time.time() - self.retention_checked > RETENTION_INTERVAL:
+                apply_retention(self.db, ARCHIVE_AGE, RETENTION_INTERVAL,
+                        self.retention_age)
+                self.retention_checked = time.time()
+
             if not self.try_to_work():
-                time.sleep(CHECK_INTERVAL)
+                self.wakeup.wait(POLL_INTERVAL)
+
+    def requeue_expired(self):
+        '''Return work items whose workers have stopped renewing their leases
+        to the queue, or fail them if they have been tried too many times.'''
+
+        now = time.time()
+
+        for table in WORK_TABLES:
+            self.db.execute('update {} set state=?, error_msg=?, claim_token=null '
+                    'where state = ? and lease_expires < ? and attempts >= ?'.format(table),
+                    [State.Failed, 'The worker processing this item died.',
+                        State.Working, now, MAX_ATTEMPTS])
+            self.db.execute('update {} set state=?, claim_token=null '
+                    'where state = ? and lease_expires < ?'.format(table),
+                    [State.New, State.Working, now])
+
+        # deletions are retried by try_deletion() until they run out of attempts
+        self.db.execute('update uploaded set state=?, error_msg=?, claim_token=null '
+                'where state = ? and claim_token is not null and lease_expires < ? '
+                'and attempts >= ?',
+                [State.DeletionFailed, 'The worker deleting this item died.',
+                    State.Deleting, now, MAX_ATTEMPTS])
+
+        # the page tasks of uploads that have failed or been deleted, which
+        # would otherwise be left in the database forever
+        self.db.execute('delete from page_tasks where upload_id not in '
+                '(select id from uploaded where state in (?, ?))',
+                [State.New, State.Working])
+        self.db.commit()
+
+    def claim(self, table='uploaded', condition='1', params=()):
+        '''Atomically take a work item from the queue in the given table,
+        optionally restricted to rows matching an SQL condition.
+
+        Returns (row, claim_token), or None if there is no work to do.'''
+
+        claim_token = uuid.uuid4().hex
+
+        cur = self.db.execute(('update {0} '
+                'set state=?, claim_token=?, lease_expires=?, attempts=attempts+1 '
+                'where id = (select id from {0} where state = ? and ({1}) order by id limit 1)'
+                ).format(table, condition),
+                [State.Working, claim_token, time.time() + LEASE_DURATION, State.New] + list(params))
+        self.db.commit()
+
+        if cur.rowcount != 1:
+            # nothing to do
+            return None
+
+        cur = self.db.execute('select * from {} where claim_token = ?'.format(table),
+                [claim_token])
+        row = cur.fetchone()
+
+        if row is None:
+            # lost the lease already
+            return None
+
+        return (row, claim_token)
 
     def try_to_work(self):
         '''Try to load and execute a work item from the database. Update the
         database while we're working on it, and finally with the
         success/failure of the work operation.
 
+        Pages of large uploads that other workers are waiting for are done
+        before new uploads.
+
         Returns True iff it has processed a work item.'''
 
-        # choose an item of work from the database
-        cur = self.db.execute('select id from uploaded where state = ? limit 1', [State.New])
-        self.db.commit()
-        row = cur.fetchone()
+        self.requeue_expired()
 
-        if row is None:
-            # nothing to do
-            return False
+        # take an item of work from the database for ourself
+        if self.try_deletion():
+            return True
 
-        id = row[0]
+        if self.try_page_task():
+            return True
 
-        # take the work for ourself
-        cur = self.db.execute('update uploaded set state=? where state = ? and id = ?',
-                [State.Working, State.New, id])
-        self.db.commit()
+        claim = self.claim()
 
-        if cur.rowcount != 1:
-            # someone got it before us
+        if claim is None:
             return False
 
+        row, claim_token = claim
+        id = row['id']
+
+        # the output is written under a name unique to this claim, and only
+        # moved into place if we still hold the lease when we finish, in case
+        # the item has been requeued and claimed by another worker meanwhile
+        output_filename = os.path.join(RESULTS, '{}.pdf'.format(id))
+        tmp_filename = '{}.{}.tmp'.format(output_filename, claim_token)
+
+        heartbeat = Heartbeat('uploaded', id, claim_token)
+        heartbeat.start()
+
         # do the work and catch any exceptions
         try:
             print 'Starting work on', id
 
             start_time = time.time()
-            self.do_work(id)
+            self.do_work(id, tmp_filename, row['page_count'])
 
         except:
             new_state = State.Failed
@@ -80,22 +238,334 @@ class Worker(object):
 
             print 'Successfully processed', id
 
+        finally:
+            heartbeat.stop()
+
         time_taken = time.time() - start_time
 
-        # record the results
-        self.db.execute('update uploaded set state=?, error_msg=?, time_taken=? where id=?',
-                [new_state, error_msg, time_taken, id])
+        # used as the ETag of the result, so the web interface never has to
+        # read the whole file
+        result_hash = ingest.hash_file(tmp_filename) if new_state == State.Succeeded else None
+
+        # record the results, unless the item has been requeued in the
+        # meantime. The update holds the database's write lock until the
+        # commit, so the lease can't be taken away while the output is moved.
+        cur = self.db.execute('update uploaded set state=?, error_msg=?, time_taken=?, '
+                'library_version=?, result_hash=?, claim_token=null where id=? and claim_token=?',
+                [new_state, error_msg, time_taken, self.resources.sigdict.version,
+                    result_hash, id, claim_token])
+
+        if cur.rowcount == 1 and new_state == State.Succeeded:
+            os.rename(tmp_filename, output_filename)
+
         self.db.commit()
 
+        if cur.rowcount != 1:
+            print 'Lost the lease on', id, 'before finishing'
+
+        # the output of a failed or abandoned attempt, if any
+        erase.secure_delete(tmp_filename)
+
         return True
 
-    def do_work(self, id):
+    def try_deletion(self):
+        '''Try to securely delete the files of an upload that a user has
+        asked to delete, then mark it as deleted.
+
+        The upload is claimed with a lease like other work items, but stays
+        in the Deleting state, so if this process dies or the deletion fails,
+        another worker will retry it when the lease expires. After
+        MAX_ATTEMPTS, the upload is left in the DeletionFailed state.
+
+        The page tasks of the upload and the match cache entries used for it
+        are deleted too, since they contain text from the document.
+
+        Returns True iff it has processed a deletion.'''
+
+        claim_token = uuid.uuid4().hex
+        now = time.time()
+
+        cur = self.db.execute('update uploaded set claim_token=?, lease_expires=?, '
+                'attempts=attempts+1 '
+                'where id = (select id from uploaded where state = ? and attempts < ? '
+                'and (claim_token is null or lease_expires < ?) order by id limit 1)',
+                [claim_token, now + LEASE_DURATION, State.Deleting, MAX_ATTEMPTS, now])
+        self.db.commit()
+
+        if cur.rowcount != 1:
+            return False
+
+        row = self.db.execute('select id, attempts from uploaded where claim_token = ?',
+                [claim_token]).fetchone()
+        if row is None:
+            return False
+
+        id = row['id']
+
+        heartbeat = Heartbeat('uploaded', id, claim_token)
+        heartbeat.start()
+
         pdf_filename = '{}.pdf'.format(id)
+        result_filename = os.path.join(RESULTS, pdf_filename)
+
+        # including the outputs of any attempts that died before finishing
+        paths = ([os.path.join(UPLOADS, pdf_filename)] +
+                glob.glob(os.path.join(RESULTS, pdf_filename + '.*.tmp')))
+
+        try:
+            for path in paths:
+                erase.secure_delete(path)
+
+            if self.result_is_shared(id, result_filename):
+                erase.unlink(result_filename)
+            else:
+                erase.secure_delete(result_filename)
+
+            self.resources.match_cache.purge(id)
+
+        except:
+            error_msg = traceback.format_exc()
+
+            print 'Failed to delete', id
+            print error_msg,
+
+            # otherwise leave it to be retried when the lease expires
+            if row['attempts'] >= MAX_ATTEMPTS:
+                self.db.execute('update uploaded set state=?, error_msg=?, claim_token=null '
+                        'where id=? and claim_token=?',
+                        [State.DeletionFailed, error_msg, id, claim_token])
+                self.db.commit()
+
+            return True
+
+        finally:
+            heartbeat.stop()
+
+        self.db.execute('update uploaded set state=?, claim_token=null '
+                'where id=? and claim_token=?', [State.Deleted, id, claim_token])
+        self.db.execute('delete from page_tasks where upload_id = ?', [id])
+        self.db.commit()
+
+        print 'Deleted', id
+
+        return True
+
+    def result_is_shared(self, id, result_filename):
+        '''Return True iff another upload that isn't being deleted has a hard
+        link to the same result file as upload id (see webif.reuse_result()).
+
+        Once an upload is being deleted, new links can only be made to its
+        result through the other uploads sharing it, so if there are none, the
+        result can safely be erased. If there are, the last of them to be
+        deleted will erase it.'''
+
+        try:
+            st = os.stat(result_filename)
+        except OSError:
+            return False
+
+        cur = self.db.execute('select id from uploaded where state = ? and id != ? and '
+                'result_hash = (select result_hash from uploaded where id = ?)',
+                [State.Succeeded, id, id])
+
+        for (other_id,) in cur.fetchall():
+            try:
+                other_st = os.stat(os.path.join(RESULTS, '{}.pdf'.format(other_id)))
+            except OSError:
+                continue
+
+            if (other_st.st_dev, other_st.st_ino) == (st.st_dev, st.st_ino):
+                return True
+
+        return False
+
+    def try_page_task(self, upload_id=None):
+        '''Try to match the pages of a page task, of the given upload or of
+        any upload, and record the matches in the database.
+
+        Returns True iff it has processed a page task.'''
+
+        if upload_id is None:
+            # only tasks of uploads whose workers are waiting for them
+            claim = self.claim('page_tasks',
+                    'upload_id in (select id from uploaded where state = ?)', [State.Working])
+        else:
+            claim = self.claim('page_tasks', 'upload_id = ?', [upload_id])
+
+        if claim is None:
+            return False
+
+        row, claim_token = claim
+
+        heartbeat = Heartbeat('page_tasks', row['id'], claim_token)
+        heartbeat.start()
+
+        input_filename = os.path.join(UPLOADS, '{}.pdf'.format(row['upload_id']))
+        pages = range(row['first_page'], row['end_page'])
+
+        try:
+            self.resources.reload_if_changed()
+            result = json.dumps(annotate.match_pages(input_filename, pages, self.resources,
+                owner=row['upload_id']))
+
+        except:
+            new_state = State.Failed
+            error_msg = traceback.format_exc()
+            result = None
+
+            print 'Failed to process pages', pages, 'of', row['upload_id']
+            print error_msg,
+
+        else:
+            new_state = State.Succeeded
+            error_msg = ''
+
+        finally:
+            heartbeat.stop()
+
+        self.db.execute('update page_tasks set state=?, error_msg=?, result=?, claim_token=null '
+                'where id=? and claim_token=?',
+                [new_state, error_msg, result, row['id'], claim_token])
+        self.db.commit()
+
+        return True
+
+    def do_work(self, id, output_filename, page_count):
+        '''Annotate an upload, given the number of pages estimated when it
+        was uploaded (see ingest.UploadFile), or None if it is unknown.'''
+
+        input_filename = os.path.join(UPLOADS, '{}.pdf'.format(id))
+
+        self.resources.reload_if_changed()
+
+        if page_count is not None and page_count < SHARD_MIN_PAGES:
+            annotate.annotate(input_filename, output_filename,
+                    resources=self.resources, incremental=True, owner=id)
+            return
+
+        # the estimate can be wrong, and every page must be in a page task
+        n_pages = pdf.SchematicReader(open(input_filename, 'rb'),
+                font_map=self.resources.font_map).getNumPages()
+
+        if n_pages < SHARD_MIN_PAGES:
+            annotate.annotate(input_filename, output_filename,
+                    resources=self.resources, incremental=True, owner=id)
+        else:
+            self.do_sharded_work(id, n_pages, input_filename, output_filename)
+
+    def do_sharded_work(self, id, n_pages, input_filename, output_filename):
+        '''Split a large upload into page tasks, which can be done by any
+        worker, then merge their matches into the output.'''
+
+        # the tasks may already exist if a previous attempt died
+        cur = self.db.execute('select count(*) from page_tasks where upload_id = ?', [id])
+        if cur.fetchone()[0] == 0:
+            for first_page in range(0, n_pages, PAGES_PER_TASK):
+                self.db.execute('insert into page_tasks (upload_id, first_page, end_page, state) '
+                        'values (?, ?, ?, ?)',
+                        [id, first_page, min(first_page + PAGES_PER_TASK, n_pages), State.New])
+            self.db.commit()
+
+            # let any idle workers help
+            for _ in range(0, n_pages, PAGES_PER_TASK):
+                wakeup.notify(WAKEUP_FIFO)
+
+        # work on our own tasks, then wait for the other workers to finish theirs
+        while True:
+            self.requeue_expired()
+
+            if self.try_page_task(id):
+                continue
+
+            cur = self.db.execute('select state, error_msg from page_tasks where upload_id = ?', [id])
+            rows = cur.fetchall()
+
+            failed = [error_msg for (state, error_msg) in rows if state == State.Failed]
+            if len(failed) > 0:
+                self.delete_page_tasks(id)
+                raise Exception('Failed to process pages:\n' + failed[0])
+
+            if all(state == State.Succeeded for (state, _) in rows):
+                break
+
+            time.sleep(CHECK_INTERVAL)
+
+        # merge the matches and write the output
+        page_matches = {}
+        cur = self.db.execute('select first_page, result from page_tasks where upload_id = ?', [id])
+        for first_page, result in cur.fetchall():
+            for i, matches in enumerate(json.loads(result)):
+                page_matches[first_page + i] = matches
+
+        annotate.annotate_from_matches(input_filename, output_filename,
+                page_matches, self.resources, incremental=True)
+
+        self.delete_page_tasks(id)
+
+    def delete_page_tasks(self, upload_id):
+        self.db.execute('delete from page_tasks where upload_id = ?', [upload_id])
+        self.db.commit()
+
+    def hash_old_results(self):
+        '''Record the hashes of results written before they were computed by
+        the workers.'''
+
+        cur = self.db.execute('select id from uploaded where state = ? and result_hash is null',
+                [State.Succeeded])
+
+        for (id,) in cur.fetchall():
+            try:
+                result_hash = ingest.hash_file(os.path.join(RESULTS, '{}.pdf'.format(id)))
+            except IOError:
+                # deleted in the meantime
+                continue
+
+            self.db.execute('update uploaded set result_hash = ? where id = ? and state = ?',
+                    [result_hash, id, State.Succeeded])
+            self.db.commit()
+
+class Heartbeat(threading.Thread):
+    '''Periodically extends the lease on a work item while it is processed,
+    so that it isn't requeued unless this process dies.
+
+    Errors such as a locked database are retried at the next interval, so
+    the lease is only lost if they persist for LEASE_DURATION.'''
+
+    def __init__(self, table, id, claim_token):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+
+        self.table = table
+        self.id = id
+        self.claim_token = claim_token
+        self.stopped = threading.Event()
+
+    def run(self):
+        # sqlite connections can't be shared between threads
+        db = connect_db(DATABASE)
+
+        try:
+            while not self.stopped.wait(HEARTBEAT_INTERVAL):
+                try:
+                    cur = db.execute('update {} set lease_expires=? where id=? and claim_token=?'.format(self.table),
+                            [time.time() + LEASE_DURATION, self.id, self.claim_token])
+                    db.commit()
+                except sqlite3.Error:
+                    print 'Failed to extend the lease on', self.table, self.id
+                    traceback.print_exc()
+                    db.rollback()
+                    continue
 
-        input_filename = os.path.join(UPLOADS, pdf_filename)
-        output_filename = os.path.join(RESULTS, pdf_filename)
+                if cur.rowcount != 1:
+                    # requeued already, so the work will be thrown away
+                    print 'Lost the lease on', self.table, self.id
+                    break
+        finally:
+            db.close()
 
-        annotate.annotate(input_filename, output_filename)
+    def stop(self):
+        self.stopped.set()
+        self.join()
 
 
 if __name__ == '__main__':